@@ -4,6 +4,9 @@ from .arealstatistics import *
 from .calibration import *
 from .config import *
 from .primVars import *
+from .inventory import *
+from .references import *
+from .resources import *
 from .derivedVars import *
 from .ensembles import *
 from .regridding import *
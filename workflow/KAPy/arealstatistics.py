@@ -22,14 +22,22 @@ import os
 from cdo import Cdo
 from . import helpers
 
-def generateArealstats(config, inFile, outFile):
+def generateArealstats(config, inFile, outFile, member=None):
     # Generate statistics over an area by applying a polygon mask and averaging
     # Setup xarray
     # Note that we need to use open_dataset here, as the ensemble files have
     # multiple data variables in them
-    thisDataSet = xr.open_dataset(inFile[0],
-                              use_cftime=True)
-    thisDat=thisDataSet.indicator
+    # Members can also be read from their slot in an ensemble cube, given by `member`.
+    # Time steps that lie outside the record of the member are dropped
+    if member is None:
+        thisDataSet = xr.open_dataset(inFile[0],
+                                  use_cftime=True)
+    else:
+        thisDataSet = helpers.openEnsembleCube(inFile[0]).sel(realization=member,drop=True).load()
+        thisCoverage = thisDataSet[helpers.cubeCoverageCoord]
+        thisDataSet = thisDataSet.isel({thisCoverage.dims[0]:thisCoverage.values})
+        thisDataSet = thisDataSet.drop_vars(helpers.cubeCoverageCoord)
+    thisDat=thisDataSet.indicator.drop_vars(helpers.binIndexCoord,errors='ignore')
 
     #Identify the time / period coordinate first
     if 'time' in thisDat.dims:
@@ -40,12 +48,17 @@ def generateArealstats(config, inFile, outFile):
         raise ValueError(f'Cannot find time or periodID coordinate in "{inFile[0]}".')
 
     # If using area weighting, get the pixel size
+    # Multi-season indicators also have a season dimension, which is dropped here
+    # as well
+    thisField=thisDat[{tCoord:0}]
+    if 'season' in thisField.dims:
+        thisField=thisField.isel(season=0,drop=True)
     if config['arealstats']['useAreaWeighting']:
         cdo=Cdo()
-        pxlSize=cdo.gridarea(input=thisDat[{tCoord:0}],
+        pxlSize=cdo.gridarea(input=thisField,
                              returnXArray='cell_area')
     else:
-        pxlSize=thisDat[{tCoord:0}]
+        pxlSize=thisField.copy()
         pxlSize.values[:]=1
 
     # If we have a shapefile defined, then work with it
@@ -62,7 +75,7 @@ def generateArealstats(config, inFile, outFile):
 
         #Apply masking and weighting and calculate
         wtThis=maskRaster*pxlSize
-        statDims=set(thisDat.dims) - set(['region','periodID','time','percentiles'])
+        statDims=set(thisDat.dims) - set(['region','periodID','time','percentiles','season'])
         wtMean = thisDat.weighted(wtThis).mean(dim=statDims)
         wtMean.name='mean'
         wtSd = thisDat.weighted(wtThis).std(dim=statDims)
@@ -76,7 +89,7 @@ def generateArealstats(config, inFile, outFile):
     #Otherwise, just average spatially
     else:
         # Average spatially over the time dimension
-        spDims =set(thisDat.dims)-set(['time','periodID','percentiles'])
+        spDims =set(thisDat.dims)-set(['time','periodID','percentiles','season'])
         spMean = thisDat.weighted(pxlSize).mean(dim=spDims)
         spMean.name='mean'
         spSd = thisDat.weighted(pxlSize).std(dim=spDims)
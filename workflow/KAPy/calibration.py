@@ -22,8 +22,12 @@ def calibrate(config,histSimFile,refFile,outFile, thisCal):
     # We choose to follow here the Xclim typology of ref / hist / sim, with the
     # assumption that the hist and sim part are contained in the same file
     #Import files - enforce loading, to avoid dask issues
-    histSimDat=helpers.readFile(histSimFile).compute()
-    refDat=helpers.readFile(refFile).compute()
+    #The integer time index is dropped, as it can't be passed through CDO and
+    #can clash with the xclim grouping
+    histSimDat=helpers.setPrecision(config,helpers.readFile(histSimFile)).compute()
+    refDat=helpers.setPrecision(config,helpers.readFile(refFile)).compute()
+    histSimDat=helpers.dropTimeIndex(histSimDat)
+    refDat=helpers.dropTimeIndex(refDat)
     calCfg=config['calibration'][thisCal]
 
     # Regrid calibration data to the refData set 
@@ -33,7 +37,7 @@ def calibrate(config,histSimFile,refFile,outFile, thisCal):
     cdo=Cdo()
     refGriddes=cdo.seltimestep('1/1',input=refDat)
     histSimNNFname=cdo.remapnn(refGriddes,input=histSimDat)
-    histSimNN=helpers.readFile(histSimNNFname,format=".nc").compute()
+    histSimNN=helpers.setPrecision(config,helpers.readFile(histSimNNFname,format=".nc",useCache=False)).compute()
 
     #Truncate time slice to the common calibration period (CP). Ensure synchronisation
     #between times and grids using nearest neighbour interpolation of
@@ -119,6 +123,11 @@ def calibrate(config,histSimFile,refFile,outFile, thisCal):
     #Finish
     res = res.transpose(*refDatCP.dims)
     res.name=calCfg['outVariable']
-    res.to_netcdf(outFile[0])
+    res = helpers.setPrecision(config, res)
+    res = helpers.addTimeIndex(res)
+    # The input hashes of the simulation don't cover the reference data, so they
+    # can't be passed on, and any indicators are recalculated in full
+    res = helpers.dropInputHashes(res)
+    helpers.writeNetCDF(config, res, outFile[0], "calibration")
 
 
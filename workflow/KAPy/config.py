@@ -52,6 +52,17 @@ def validateConfig(config):
     # Validate configuration file
     validate(config, os.path.join(schemaDir, "config.schema.json"))
 
+    # Resolve the storage format for primary variables. The legacy boolean
+    # picklePrimaryVariables option is still honoured if primaryVariableFormat
+    # is not set explicitly
+    procCfg = config["processing"]
+    if "primaryVariableFormat" not in procCfg:
+        if "picklePrimaryVariables" not in procCfg:
+            sys.exit("Either 'primaryVariableFormat' or 'picklePrimaryVariables' "
+                     + "must be set in the processing configuration.")
+        procCfg["primaryVariableFormat"] = \
+            "pickle" if procCfg["picklePrimaryVariables"] else "netcdf"
+
     # Now check that the other configuration tables exist
     for thisKey, thisPath in config["configurationTables"].items():
         if not os.path.exists(thisPath):
@@ -127,13 +138,31 @@ def validateConfig(config):
         # Write the integers back to finish
         config["seasons"][thisKey]["months"] = theseMnths
 
-    # Season selected in the indicator table must be valid
-    # Currently allow only one season per indicator. This needs to be fixed in the future
+    # Seasons selected in the indicator table must be valid. Several seasons can be
+    # requested as a comma-separated list
     indTbl = pd.DataFrame.from_dict(config["indicators"], orient="index")
     validSeasons = list(config["seasons"].keys()) + ["all"]
     for seasonRequest in indTbl["season"]:
-        if not (all([this in validSeasons for this in [seasonRequest]])):
+        theseSeasons = [x.strip() for x in seasonRequest.split(",")]
+        if not (all([this in validSeasons for this in theseSeasons])):
             sys.exit(f"Unknown season specified in: {seasonRequest}")
+        if ("all" in theseSeasons) and (len(theseSeasons) > 1):
+            sys.exit(f"'all' cannot be combined with other seasons in: {seasonRequest}")
+
+    # Statistics that require a threshold or a percentile must have a valid one
+    for thisKey, thisInd in config["indicators"].items():
+        if thisInd["statistic"] in ["count_above", "count_below"]:
+            try:
+                float(thisInd.get("threshold", ""))
+            except ValueError:
+                sys.exit(f"Indicator '{thisKey}' requires a numeric threshold.")
+        if thisInd["statistic"] == "percentile":
+            try:
+                thisPercentile = float(thisInd.get("percentile", ""))
+            except ValueError:
+                sys.exit(f"Indicator '{thisKey}' requires a numeric percentile.")
+            if not (0 <= thisPercentile <= 100):
+                sys.exit(f"Percentile for indicator '{thisKey}' must be between 0 and 100.")
 
     return config
 
@@ -49,4 +49,5 @@ def buildDerivedVar(config, inFiles, outFile, thisVar):
 
     # Write the results to disk
     out.name = thisVar["id"]
-    out.to_netcdf(outFile[0])
+    out = helpers.dropInputHashes(out)
+    helpers.writeNetCDF(config, out, outFile[0], "variables")
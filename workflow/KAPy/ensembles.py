@@ -10,8 +10,21 @@ outFile=[next(iter(wf['ensstats'].keys()))]
 inFiles=wf['ensstats'][outFile[0]]
 """
 
+import os
+import json
+import shutil
+import dask
+import dask.array as da
+import numpy as np
 import xarray as xr
 import xclim.ensembles as xcEns
+from xclim.core.utils import calc_perc
+from . import helpers
+from . import regridding
+
+# Dimensions that are not spatial, and are not split into tiles. Ensemble members
+# are aligned along these
+nonSpatialDims = regridding.sliceDims + [helpers.binIndexCoord]
 
 
 def generateEnsstats(config, inFiles, outFile):
@@ -22,16 +35,300 @@ def generateEnsstats(config, inFiles, outFile):
     # However, this is quite fancy, and does a lot of logic about calendars that
     # create further problems. It also doesn't seem to handle cftime calendars at all well
     # Instead, we do it by directly opening the files with open_mfdataset. 
-    thisEns = xr.open_mfdataset(inFiles, 
-                                concat_dim="realization", 
-                                combine="nested",
-                                coords="all",
-                                use_cftime=True)
+    # Year- and month-binned indicators carry a calendar-independent bin index, and
+    # if available, we align the members on that rather than decoding the time axis
+    # of each file. Ensemble cubes have already been aligned in this way
+    if helpers.isEnsembleCube(inFiles):
+        useBinIndex = False
+    else:
+        with xr.open_dataset(inFiles[0], decode_times=False) as ds:
+            useBinIndex = helpers.binIndexCoord in ds.variables
+    if config["processing"]["ensembleTileSize"] > 0:
+        # Streaming, tiled calculation with bounded memory
+        ensStream = streamEnsstats(config, inFiles, useBinIndex)
+        ensOut = helpers.setPrecision(config, ensStream)
+        if useBinIndex:
+            ensOut = helpers.binIndexToTime(ensOut)
+        helpers.writeNetCDF(config, ensOut, outFile[0], "ensstats")
+        ensStream.close()
+        return
+    if helpers.isEnsembleCube(inFiles):
+        thisEns = helpers.openEnsembleCube(inFiles[0]).drop_vars(helpers.cubeCoverageCoord, errors="ignore")
+    elif useBinIndex:
+        thisEns = xr.open_mfdataset(inFiles, 
+                                    concat_dim="realization", 
+                                    combine="nested",
+                                    coords="all",
+                                    decode_times=False,
+                                    preprocess=helpers.binIndexToDim)
+    else:
+        thisEns = xr.open_mfdataset(inFiles, 
+                                    concat_dim="realization", 
+                                    combine="nested",
+                                    coords="all",
+                                    use_cftime=True)
+    thisEns = helpers.dropInputHashes(helpers.setPrecision(config, thisEns))
     # Calculate the statistics
     ens_mean_std = xcEns.ensemble_mean_std_max_min(thisEns)
     ens_percs = xcEns.ensemble_percentiles(
         thisEns, split=False, values=[x for x in config["ensembles"].values()]
     )
-    ensOut = xr.merge([ens_mean_std, ens_percs])
+    ensOut = helpers.setPrecision(config, xr.merge([ens_mean_std, ens_percs]))
+    if useBinIndex:
+        ensOut = helpers.binIndexToTime(ensOut)
     # Write results
-    ensOut.to_netcdf(outFile[0])
+    helpers.writeNetCDF(config, ensOut, outFile[0], "ensstats")
+
+
+def openMember(thisPath, useBinIndex):
+    # Open a single ensemble member lazily, without dask, so that subsets can be
+    # read directly from disk. Members are aligned on the bin index where available,
+    # as in generateEnsstats
+    if useBinIndex:
+        return helpers.binIndexToDim(xr.open_dataset(thisPath, decode_times=False))
+    return xr.open_dataset(thisPath, use_cftime=True)
+
+
+def openEnsemble(inFiles, useBinIndex):
+    # Open the members of an ensemble lazily, as a list of datasets, either from the
+    # individual member files or from the slots of an ensemble cube
+    if helpers.isEnsembleCube(inFiles):
+        thisCube = helpers.openEnsembleCube(inFiles[0], chunks=None)
+        thisCube = thisCube.drop_vars(helpers.cubeCoverageCoord, errors="ignore")
+        return [thisCube.isel(realization=i, drop=True) for i in range(thisCube.sizes["realization"])]
+    return [helpers.dropInputHashes(openMember(f, useBinIndex)) for f in inFiles]
+
+
+def tileLayout(theseSizes, spatialDims, tileSize):
+    # Number of cells along each spatial dimension in a tile of around `tileSize`
+    # cells. Tiles are made up of whole rows along the first spatial dimension. If a
+    # single row is larger than the tile size, the last spatial dimension is split
+    # as well. Dimensions that are not given are kept whole
+    if (len(spatialDims) == 0) or (tileSize == 0):
+        return {}
+    rowDim, colDim = spatialDims[0], spatialDims[-1]
+    rowSize = int(np.prod([theseSizes[d] for d in spatialDims[1:]]))
+    if (rowSize <= tileSize) or (len(spatialDims) == 1):
+        return {rowDim: max(tileSize // rowSize, 1)}
+    return {rowDim: 1, colDim: max(tileSize // (rowSize // theseSizes[colDim]), 1)}
+
+
+def ensembleTile(memberVars, tile, alignIdxs, percentiles, outDtype):
+    """
+    Ensemble statistics of a tile
+
+    Streams the members of the ensemble (`memberVars`, lazily opened DataArrays) one
+    at a time over a single tile of the spatial domain, accumulating the mean,
+    standard deviation, minimum and maximum online (Welford's algorithm). The tile of
+    each member is retained, so that the percentiles can be calculated exactly once
+    all of the members have been read, using the same routine as xclim. Missing
+    values are skipped, as in xclim. Returns a dict of numpy arrays.
+    """
+    for i, thisVar in enumerate(memberVars):
+        thisDat = thisVar.isel(tile).load()
+        # Align onto the common non-spatial axes of the ensemble
+        thisDat = thisDat.reindex({d: idx for d, idx in alignIdxs.items() if d in thisDat.dims})
+        x = thisDat.values.astype(np.float64)
+        if i == 0:
+            tileStack = np.empty((len(memberVars),) + x.shape, dtype=np.float64)
+            n = np.zeros(x.shape)
+            datMean = np.zeros(x.shape)
+            M2 = np.zeros(x.shape)
+            datMax = np.full(x.shape, np.nan)
+            datMin = np.full(x.shape, np.nan)
+        tileStack[i] = x
+        isValid = np.isfinite(x)
+        n += isValid
+        delta = np.where(isValid, x - datMean, 0)
+        datMean += np.where(isValid, delta / np.maximum(n, 1), 0)
+        M2 += np.where(isValid, delta * (x - datMean), 0)
+        datMax = np.fmax(datMax, x)
+        datMin = np.fmin(datMin, x)
+    # Cells without any valid members are set to missing. The standard deviation is
+    # the population standard deviation, as in xclim
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rtn = {"mean": np.where(n > 0, datMean, np.nan),
+               "stdev": np.where(n > 0, np.sqrt(M2 / n), np.nan),
+               "max": datMax,
+               "min": datMin,
+               "percentiles": calc_perc(np.moveaxis(tileStack, 0, -1), percentiles, copy=False)}
+    return {k: v.astype(outDtype) for k, v in rtn.items()}
+
+
+def streamEnsstats(config, inFiles, useBinIndex):
+    """
+    Streaming ensemble statistics
+
+    Sets up the same ensemble statistics as generateEnsstats, but without holding
+    the full ensemble in memory. The spatial domain is split into tiles of around
+    `processing.ensembleTileSize` grid cells, and each tile is calculated by
+    streaming the members through it (see ensembleTile). The statistics are returned
+    as a lazy dataset, built from one dask task per tile, so that tiles are calculated
+    in parallel as the output is written. Peak memory is then set by the size of a
+    tile times the number of members (times the number of threads), rather than by
+    the size of the full ensemble. The members are closed when the returned dataset
+    is closed.
+    """
+    percentiles = [x for x in config["ensembles"].values()]
+    tileSize = config["processing"]["ensembleTileSize"]
+
+    # Open the members lazily. Each member is opened once, and the tiles then read
+    # their subsets directly from disk. Members are aligned on their non-spatial
+    # coordinates with an outer join, as with open_mfdataset. Only the coordinates
+    # are read at this point
+    members = openEnsemble(inFiles, useBinIndex)
+    theseVars = [v for v in members[0].data_vars
+                 if all([v in m.data_vars for m in members])]
+    ensOut = xr.align(*[m.drop_vars(m.data_vars) for m in members], join="outer")[0]
+    ensOut.attrs = members[0].attrs
+
+    for v in theseVars:
+        thisVar = members[0][v]
+        theseDims = list(thisVar.dims)
+        theseSizes = {d: ensOut.sizes[d] for d in theseDims}
+        spatialDims = [d for d in theseDims if d not in nonSpatialDims]
+        alignIdxs = {d: ensOut.indexes[d] for d in theseDims
+                     if (d not in spatialDims) and (d in ensOut.indexes)}
+        outDtype = thisVar.dtype if np.issubdtype(thisVar.dtype, np.floating) else np.dtype("float64")
+        # Tiles are laid out as a list of rows, each of which is a list of tiles
+        thisLayout = tileLayout(theseSizes, spatialDims, tileSize)
+        if len(spatialDims) == 0:
+            tileRows = [[{}]]
+        else:
+            rowDim, colDim = spatialDims[0], spatialDims[-1]
+            rowStep = thisLayout[rowDim]
+            if colDim in thisLayout and colDim != rowDim:
+                colStep = thisLayout[colDim]
+                tileRows = [[{rowDim: slice(i, i + 1),
+                              colDim: slice(j, min(j + colStep, theseSizes[colDim]))}
+                             for j in range(0, theseSizes[colDim], colStep)]
+                            for i in range(theseSizes[rowDim])]
+            else:
+                tileRows = [[{rowDim: slice(i, min(i + rowStep, theseSizes[rowDim]))}]
+                            for i in range(0, theseSizes[rowDim], rowStep)]
+        tileTasks = [[dask.delayed(ensembleTile)([m[v] for m in members], thisTile,
+                                                 alignIdxs, percentiles, outDtype)
+                      for thisTile in thisRow] for thisRow in tileRows]
+
+        # Assemble the tiles of each statistic into a dask array
+        def assemble(stat, extraShape=()):
+            theseRows = []
+            for thisRow, theseTasks in zip(tileRows, tileTasks):
+                theseBlocks = [da.from_delayed(thisTask[stat],
+                                               shape=tuple(len(range(n)[thisTile.get(d, slice(None))])
+                                                           for d, n in theseSizes.items()) + extraShape,
+                                               dtype=outDtype)
+                               for thisTile, thisTask in zip(thisRow, theseTasks)]
+                theseRows += [da.concatenate(theseBlocks, axis=theseDims.index(colDim))
+                              if len(theseBlocks) > 1 else theseBlocks[0]]
+            return da.concatenate(theseRows, axis=theseDims.index(rowDim)) if len(theseRows) > 1 else theseRows[0]
+
+        for stat in ["mean", "stdev", "max", "min"]:
+            ensOut[f"{v}_{stat}"] = xr.DataArray(assemble(stat), dims=theseDims, attrs=thisVar.attrs)
+        ensOut[v] = xr.DataArray(assemble("percentiles", (len(percentiles),)),
+                                 dims=theseDims + ["percentiles"], attrs=thisVar.attrs)
+    ensOut = ensOut.assign_coords(percentiles=xr.DataArray(percentiles, dims=("percentiles",)))
+    ensOut.set_close(lambda: [m.close() for m in members])
+    return ensOut
+
+
+def buildEnsembleCube(config, inFiles, outFile):
+    """
+    Build ensemble cube
+
+    Collects the members of an ensemble into a single Zarr store, with a
+    `realization` dimension labelled by the name of each member file. Members are
+    aligned on their non-spatial coordinates with an outer join, as in
+    generateEnsstats, and are written into their slots one at a time. The store is
+    updated in place: members that are new are appended, members whose files have
+    changed are rewritten in their slot, and members that are unchanged are left
+    alone. The store is rebuilt if members have been removed, or if the structure of
+    the ensemble (e.g. its time axis) has changed. Chunks hold a single member, and
+    follow the tiles of the streaming ensemble statistics (see
+    `processing.ensembleTileSize`), if used.
+    """
+    # Zarr is only required when ensemble cubes are used
+    import zarr
+
+    cubePath = outFile[0]
+    with xr.open_dataset(inFiles[0], decode_times=False) as ds:
+        useBinIndex = helpers.binIndexCoord in ds.variables
+    theseLabels = [os.path.basename(f) for f in inFiles]
+    members = dict(zip(theseLabels, openEnsemble(inFiles, useBinIndex)))
+    theseSignatures = {label: f"{os.stat(f).st_mtime_ns}|{os.stat(f).st_size}"
+                       for label, f in zip(theseLabels, inFiles)}
+
+    # Common coordinates of the members, and the chunk layout
+    template = xr.align(*[m.drop_vars(m.data_vars) for m in members.values()], join="outer")[0]
+    firstVar = next(iter(members.values()))
+    firstVar = firstVar[list(firstVar.data_vars)[0]]
+    spatialDims = [d for d in firstVar.dims if d not in nonSpatialDims]
+    theseChunks = {"realization": 1,
+                   **tileLayout(template.sizes, spatialDims, config["processing"]["ensembleTileSize"])}
+
+    tDim = [d for d in [helpers.binIndexCoord, "time", "periodID"] if d in firstVar.dims][0]
+
+    def cubeSlot(label):
+        # A single member, aligned and ready to be written into its slot, together
+        # with the time steps that it covers
+        thisSlot = members[label]
+        thisCoverage = template.indexes[tDim].isin(thisSlot.indexes[tDim])
+        thisSlot = thisSlot.reindex(dict(template.indexes))
+        thisSlot = thisSlot.assign_coords({helpers.cubeCoverageCoord: (tDim, thisCoverage)})
+        if useBinIndex:
+            thisSlot = helpers.binIndexToTime(thisSlot)
+        thisSlot = thisSlot.expand_dims(realization=[label])
+        thisSlot[helpers.cubeCoverageCoord] = thisSlot[helpers.cubeCoverageCoord].expand_dims(realization=[label])
+        for thisVar in thisSlot.variables.values():
+            thisVar.encoding = {}
+        return thisSlot.chunk({d: theseChunks.get(d, -1) for d in thisSlot.dims})
+
+    # Check whether the existing store can be updated. The signatures are only
+    # written once all of the members are in place, so a store with missing
+    # signatures is incomplete and is rebuilt
+    doRebuild = True
+    if os.path.exists(cubePath):
+        try:
+            with xr.open_zarr(cubePath, consolidated=True, use_cftime=True, chunks=None) as thisCube:
+                oldSignatures = json.loads(thisCube.attrs.get(helpers.cubeSignaturesAttr, "{}"))
+                oldLabels = list(thisCube["realization"].values)
+                firstSlot = cubeSlot(theseLabels[0])
+                doRebuild = ((len(oldSignatures) == 0)
+                             or (not set(oldLabels).issubset(theseLabels))
+                             or (set(thisCube.variables) != set(firstSlot.variables))
+                             or any([not thisCube.indexes[d].equals(firstSlot.indexes[d])
+                                     for d in firstSlot.indexes if d != "realization"]))
+        except (OSError, ValueError, KeyError):
+            doRebuild = True
+    if doRebuild:
+        shutil.rmtree(cubePath, ignore_errors=True)
+        oldSignatures, oldLabels = {}, []
+    else:
+        # Remove the signatures until the update is complete
+        thisGroup = zarr.open_group(cubePath, mode="r+")
+        thisGroup.attrs.pop(helpers.cubeSignaturesAttr, None)
+        zarr.consolidate_metadata(cubePath)
+
+    # Write the members that are new or have changed into their slots, one at a time
+    for label in theseLabels:
+        if oldSignatures.get(label) == theseSignatures[label]:
+            continue
+        thisSlot = cubeSlot(label)
+        if not os.path.exists(cubePath):
+            thisSlot.attrs = {k: v for k, v in thisSlot.attrs.items() if k != helpers.cubeSignaturesAttr}
+            thisSlot.to_zarr(cubePath, mode="w", consolidated=True)
+        elif label in oldLabels:
+            # Variables without a realization dimension are shared, and are left as is
+            i = oldLabels.index(label)
+            thisSlot = thisSlot.drop_vars([v for v in thisSlot.variables
+                                           if "realization" not in thisSlot[v].dims])
+            thisSlot.to_zarr(cubePath, region={"realization": slice(i, i + 1)}, consolidated=True)
+        else:
+            thisSlot.to_zarr(cubePath, append_dim="realization", consolidated=True)
+
+    # Record the signatures, completing the update
+    thisGroup = zarr.open_group(cubePath, mode="r+")
+    thisGroup.attrs[helpers.cubeSignaturesAttr] = json.dumps(theseSignatures)
+    zarr.consolidate_metadata(cubePath)
+    for m in members.values():
+        m.close()
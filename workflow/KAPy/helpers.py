@@ -7,28 +7,318 @@ thisPath='outputs/1.primVars/pr_KA-ba_rcp26_EUR-11_CCCma-CanESM2r1i1p1_CLMcom-CC
 
 import pickle
 import xarray as xr
+import numpy as np
 import os
+import threading
+import contextlib
+import cftime
+import dask
+from collections import OrderedDict
 
+# Per-process cache of opened datasets, used by readFile(). Entries are keyed by 
+# path, modification time and size, so that a file that has been rewritten is 
+# opened afresh. The least recently used entry is evicted when the cache is full
+fileCache = OrderedDict()
+fileCacheMaxSize = 8
+fileCacheLock = threading.Lock()
 
-def readFile(thisPath,format=None):
+# Names of the integer time index coordinates attached to the time axis at ingestion
+timeIndexCoords = {"year": "time_year",
+                   "month": "time_month",
+                   "dayofyear": "time_dayofyear"}
+
+# Calendar-independent index attached to the time bins of year- and month-binned
+# indicators, given as year*12 + month - 1
+binIndexCoord = "time_yearMonth"
+
+# Attribute of primary variables giving a hash of the input files covering each year,
+# stored as a JSON string. Used for the incremental calculation of indicators
+inputHashesAttr = "inputYearHashes"
+
+# Attribute of ensemble cubes giving the signature (modification time and size) of
+# the file that each member was read from, stored as a JSON string. Used to update
+# the cubes in place
+cubeSignaturesAttr = "memberSignatures"
+
+# Coordinate of ensemble cubes marking the time steps (or periods) that are covered by
+# the record of each member, as opposed to those added when aligning the members
+cubeCoverageCoord = "memberCoverage"
+
+
+def readFile(thisPath,format=None,useCache=True):
     # Reads a dataset from disk, determining dynmaically whether it is
-    # pickled or NetCDF based on the file extension
+    # pickled, NetCDF or a Zarr store based on the file extension. 
+    # Opened datasets are held in the file cache, so that repeated reads of
+    # the same file within a process only cost one open
     if format==None:
         format = os.path.splitext(os.path.basename(thisPath))[1]
+    if useCache:
+        thisStat = os.stat(thisPath)
+        cacheKey = (os.path.abspath(thisPath), thisStat.st_mtime_ns, thisStat.st_size, format)
+        with fileCacheLock:
+            if cacheKey in fileCache:
+                fileCache.move_to_end(cacheKey)
+                return fileCache[cacheKey]
     if format == ".nc":
         thisDat = xr.open_dataarray(thisPath,
                                     use_cftime=True)
     elif format == ".pkl":  # Read pickle
         with open(thisPath, "rb") as f:
             thisDat = pickle.load(f)
+    elif format == ".zarr":  # Read zarr store
+        # Zarr stores are written as datasets containing a single data variable
+        thisDS = xr.open_zarr(thisPath,
+                              consolidated=True,
+                              use_cftime=True)
+        if len(thisDS.data_vars) != 1:
+            raise IOError(f"Expected a single data variable in '{thisPath}' but " +
+                          f"found {len(thisDS.data_vars)}.")
+        thisDat = thisDS[list(thisDS.data_vars)[0]]
     else:
         raise IOError(f"Unknown file format, '{format}' inferred from: '{thisPath}'.")
+    if useCache:
+        with fileCacheLock:
+            fileCache[cacheKey] = thisDat
+            while len(fileCache) > fileCacheMaxSize:
+                fileCache.popitem(last=False)[1].close()
     return thisDat
 
 
+def clearFileCache(thisPath=None):
+    # Evicts datasets from the file cache and closes them. If a path is given, 
+    # only the entries for that path are evicted, otherwise the cache is emptied
+    with fileCacheLock:
+        theseKeys = [k for k in fileCache.keys()
+                     if (thisPath is None) or (k[0] == os.path.abspath(thisPath))]
+        for thisKey in theseKeys:
+            fileCache.pop(thisKey).close()
+
+
+def openReference(thisPath, chunks={}):
+    # Opens a virtual (kerchunk) reference index as a single dataset. Data
+    # is read directly from the original files, using the byte ranges in the index
+    thisDS = xr.open_dataset("reference://",
+                             engine="zarr",
+                             use_cftime=True,
+                             chunks=chunks,
+                             backend_kwargs={"consolidated": False,
+                                             "storage_options": {"fo": thisPath}})
+    return thisDS
+
+
+def isEnsembleCube(inFiles):
+    # Ensemble cubes are passed on as a single Zarr store, in place of the list of
+    # member files
+    return (len(inFiles) == 1) and inFiles[0].endswith(".zarr")
+
+
+def openEnsembleCube(thisPath, chunks={}):
+    # Opens an ensemble cube written by buildEnsembleCube. The signatures used to
+    # keep track of the members are dropped, as they do not describe the data. With
+    # chunks=None, the data is read lazily without dask
+    thisDS = xr.open_zarr(thisPath,
+                          consolidated=True,
+                          use_cftime=True,
+                          chunks=chunks)
+    thisDS.attrs.pop(cubeSignaturesAttr, None)
+    return thisDS
+
+
+def addTimeIndex(dat):
+    # Attach integer year, month and day-of-year coordinates to the time axis. Working
+    # with the cftime objects directly requires a loop in Python over each element, so 
+    # we do this once only, at ingestion, and then use the integer arrays thereafter
+    newCoords = {thisCoord: ("time", getattr(dat.time.dt, thisField).values.astype(np.int16))
+                 for thisField, thisCoord in timeIndexCoords.items()
+                 if thisCoord not in dat.coords}
+    return dat.assign_coords(newCoords)
+
+
+def dropTimeIndex(dat):
+    # Remove the integer time index coordinates e.g. before passing to CDO
+    return dat.drop_vars(list(timeIndexCoords.values()), errors="ignore")
+
+
+def timeIndex(dat, field):
+    # Integer year, month or dayofyear of each time step. The precomputed time index
+    # coordinates are used if available, with the datetime accessor as a fallback
+    if timeIndexCoords[field] in dat.coords:
+        return dat[timeIndexCoords[field]].values
+    return getattr(dat.time.dt, field).values
+
+
 def timeslice(this,startYr,endYr):
-    # Slice dataset
-    timemin = this.time.dt.year >= int(startYr)
-    timemax = this.time.dt.year <= int(endYr)
-    sliced = this.sel(time=timemin & timemax)
+    # Slice dataset. If the years are in order, as they normally are, we can use a 
+    # binary search rather than building a mask
+    years = timeIndex(this, "year")
+    if np.all(np.diff(years) >= 0):
+        sliced = this.isel(time=slice(np.searchsorted(years, int(startYr), side="left"),
+                                      np.searchsorted(years, int(endYr), side="right")))
+    else:
+        sliced = this.isel(time=(years >= int(startYr)) & (years <= int(endYr)))
     return sliced
+
+
+def binTimes(yearMonths):
+    # Normalised time axis for year- and month-binned indicators, given the bins as
+    # integer indices (year*12 + month - 1). Every bin is placed at the middle of its
+    # month in the standard calendar, so that everything has an identical datetime,
+    # regardless of the calendar being used. cftime objects are used, for runs that go
+    # out past 2262. The bins are converted to day offsets as integer arrays, using
+    # month-resolution datetime64 (which doesn't have this limit), and the objects are
+    # then built in one hit
+    firstDays = np.asarray(yearMonths, dtype=np.int64) - (1970 * 12)
+    dayOffsets = firstDays.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + 14
+    return cftime.num2date(dayOffsets, "days since 1970-01-01", calendar="standard")
+
+
+def binIndexToDim(dat):
+    # Replace the time axis by the calendar-independent bin index, so that files can be
+    # aligned without decoding their times
+    return dat.swap_dims(time=binIndexCoord).drop_vars("time")
+
+
+def binIndexToTime(dat):
+    # Restore the time axis from the bin index
+    dat = dat.assign_coords(time=(binIndexCoord, binTimes(dat[binIndexCoord].values)))
+    return dat.swap_dims({binIndexCoord: "time"})
+
+
+def dropInputHashes(dat):
+    # Remove the input hashes used for incremental calculation of the indicators (and
+    # the accompanying signature), where they no longer describe the data
+    theseVars = dat.data_vars.values() if isinstance(dat, xr.Dataset) else [dat]
+    for thisVar in theseVars:
+        for thisAttr in [inputHashesAttr, "indicatorSignature"]:
+            thisVar.attrs.pop(thisAttr, None)
+    return dat
+
+
+def indicatorSeasons(config, thisInd):
+    # List of the seasons requested by an indicator. Seasons are given as a
+    # comma-separated list of IDs, and "all" selects all of the defined seasons
+    theseSeasons = [x.strip() for x in thisInd["season"].split(",")]
+    if theseSeasons == ["all"]:
+        theseSeasons = list(config["seasons"].keys())
+    return theseSeasons
+
+
+def isMultiSeason(thisInd):
+    # Indicators requesting more than one season (or "all") get a season dimension
+    return ("," in thisInd["season"]) or (thisInd["season"].strip() == "all")
+
+
+def stageResources(config, stage):
+    # Threads and memory (in MB) requested by each job in a stage, keyed as in `dirs`.
+    # Settings for the stage take precedence over the defaults. A memory of zero
+    # means that no requirement is declared
+    daskCfg = config["processing"]["dask"]
+    theseRes = {"threads": daskCfg["threads"], "mem_mb": daskCfg["mem_mb"]}
+    theseRes.update(daskCfg["stages"].get(stage, {}))
+    return theseRes
+
+
+def daskScheduler(config, threads, memMB=0):
+    """
+    Setup dask scheduler
+
+    Returns a context manager that runs dask computations within it on the scheduler
+    set by processing.dask, limited to the given number of threads. With the
+    `distributed` scheduler, a local cluster is started for the duration of the
+    context, with the memory `memMB` (in MB) split between its workers. Spilling to
+    disk, where supported, goes to the configured spill directory.
+    """
+    daskCfg = config["processing"]["dask"]
+    baseCfg = {}
+    if daskCfg["spillDirectory"] != "":
+        baseCfg["temporary_directory"] = daskCfg["spillDirectory"]
+    if daskCfg["scheduler"] == "default":
+        return dask.config.set(baseCfg)
+    elif daskCfg["scheduler"] == "synchronous":
+        return dask.config.set({**baseCfg, "scheduler": "synchronous"})
+    elif daskCfg["scheduler"] in ["threads", "processes"]:
+        return dask.config.set({**baseCfg,
+                                "scheduler": daskCfg["scheduler"],
+                                "num_workers": threads})
+
+    # Distributed scheduler. The threads are shared between the workers, and the
+    # memory limit per worker is taken from the configuration if given
+    from dask.distributed import LocalCluster, Client
+    nWorkers = min(daskCfg["workers"], threads)
+    if daskCfg["memoryLimit"] != "":
+        memoryLimit = daskCfg["memoryLimit"]
+    elif memMB > 0:
+        memoryLimit = f"{memMB // nWorkers}MB"
+    else:
+        memoryLimit = "auto"
+    stack = contextlib.ExitStack()
+    stack.enter_context(dask.config.set(baseCfg))
+    cluster = stack.enter_context(
+        LocalCluster(n_workers=nWorkers,
+                     threads_per_worker=max(threads // nWorkers, 1),
+                     memory_limit=memoryLimit,
+                     local_directory=daskCfg["spillDirectory"] or None,
+                     dashboard_address=None))
+    stack.enter_context(Client(cluster))
+    return stack
+
+
+def setPrecision(config, dat):
+    # Cast floating point data to the working precision set by processing.precision.
+    # Works on both DataArrays and Datasets. Non-floating point data is left as is
+    if config["processing"]["precision"] != "float32":
+        return dat
+    if isinstance(dat, xr.Dataset):
+        return dat.map(lambda x: setPrecision(config, x), keep_attrs=True)
+    if np.issubdtype(dat.dtype, np.floating) and (dat.dtype != np.float32):
+        dat = dat.astype(np.float32, keep_attrs=True)
+    return dat
+
+
+def writeNetCDF(config, dat, thisPath, stage, compute=True):
+    """
+    Write NetCDF file
+
+    Writes a DataArray or Dataset to a NetCDF file, applying the output encoding
+    policy defined in the processing.encoding configuration: compression, chunk
+    shapes for the given stage (keyed as in `dirs`) and conversion of floating point
+    data to float32 or to packed 16-bit integers. With `compute=False`, dask-backed
+    data is not written immediately, and a delayed object is returned instead.
+    """
+    if isinstance(dat, xr.DataArray):
+        dat = dat.to_dataset(name=dat.name or "__xarray_dataarray_variable__")
+    encCfg = config["processing"]["encoding"]
+    chunkCfg = encCfg["chunks"].get(stage, {})
+    # Packing into 16-bit integers spans the range of the data. The ranges of all of
+    # the variables are found together, in a single pass over the data
+    packedVars = [v for v in dat.data_vars
+                  if encCfg["packing"] and np.issubdtype(dat[v].dtype, np.floating)]
+    packRanges = dask.compute({v: (dat[v].min(), dat[v].max()) for v in packedVars})[0]
+    encoding = {}
+    for thisVar in dat.data_vars:
+        thisDat = dat[thisVar]
+        thisEnc = {}
+        # Compression
+        if encCfg["compression"] != "none":
+            thisEnc["compression"] = encCfg["compression"]
+            thisEnc["complevel"] = encCfg["complevel"]
+            thisEnc["shuffle"] = True
+        # Chunk shapes. Dimensions that are not specified are kept whole
+        if (len(chunkCfg) > 0) and (thisDat.ndim > 0):
+            thisEnc["chunksizes"] = tuple(min(chunkCfg.get(d, n), n)
+                                          for d, n in thisDat.sizes.items())
+        # Precision. Only floating point data is affected
+        if np.issubdtype(thisDat.dtype, np.floating):
+            if encCfg["packing"]:
+                # Pack into 16-bit integers, keeping the lowest value free for
+                # missing values
+                datMin, datMax = [float(x) for x in packRanges[thisVar]]
+            if encCfg["packing"] and np.isfinite([datMin, datMax]).all():
+                thisEnc["dtype"] = "int16"
+                thisEnc["scale_factor"] = max((datMax - datMin) / (2**16 - 2), np.finfo("float32").tiny)
+                thisEnc["add_offset"] = (datMax + datMin) / 2
+                thisEnc["_FillValue"] = np.iinfo("int16").min
+            elif encCfg["dtype"] == "float32":
+                thisEnc["dtype"] = "float32"
+        encoding[thisVar] = thisEnc
+    return dat.to_netcdf(thisPath, encoding=encoding, compute=compute)
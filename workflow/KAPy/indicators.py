@@ -20,79 +20,204 @@ import xarray as xr
 import numpy as np
 import pandas as pd
 import sys
-import cftime
+import os
+import json
+import shutil
+import hashlib
+import dask
+import dask.array
 from . import helpers 
 
+def thresholdExceedance(dat, threshold, above):
+    # Flags values above (or below) the threshold as ones and the rest as zeros, in the
+    # precision of the data. Missing values remain missing
+    exceeds = (dat > threshold) if above else (dat < threshold)
+    return exceeds.astype(dat.dtype).where(dat.notnull())
+
+
+# Registry of the statistics available for indicators. Each statistic is defined by an
+# optional elementwise transform of the data, applied after season selection, and a
+# reduction over the time bins (mean, sum, min, max or quantile). All are vectorised
+# and work on both in-memory and dask-backed data
+indicatorStatistics = {
+    "mean": {"transform": None, "reduction": "mean"},
+    "sum": {"transform": None, "reduction": "sum"},
+    "min": {"transform": None, "reduction": "min"},
+    "max": {"transform": None, "reduction": "max"},
+    "count_above": {"transform": lambda dat, thisInd:
+                        thresholdExceedance(dat, float(thisInd["threshold"]), above=True),
+                    "reduction": "sum"},
+    "count_below": {"transform": lambda dat, thisInd:
+                        thresholdExceedance(dat, float(thisInd["threshold"]), above=False),
+                    "reduction": "sum"},
+    "percentile": {"transform": None, "reduction": "quantile"},
+}
+
+# Reductions used to build up each statistic from partial results. Means and sums are
+# built up from partial sums and counts of valid values
+partialReductions = {"mean": "sum", "sum": "sum", "min": "min", "max": "max"}
+
+
+def usesMonthlyCube(thisInd):
+    # Indicators that can be derived from the monthly aggregates in the monthly cube
+    thisStat = indicatorStatistics.get(thisInd["statistic"], {})
+    return (thisStat.get("transform", "") is None) and (thisStat["reduction"] in partialReductions)
+
+
 def calculateIndicators(config, inFile, outFile, indID):
+    """
+    Calculate indicator
+
+    Calculates a single indicator from a primary variable file and writes it out.
+    """
+    # Read the dataset object back from disk, depending on the configuration. The
+    # monthly cube, if present, follows the primary variable
+    thisDat = helpers.setPrecision(config, helpers.readFile(inFile[0]))
+    shared = {}
+    if len(inFile) > 1:
+        shared[("monthlyCube",)] = xr.open_dataset(inFile[1], chunks={})
+
+    # Calculate and write out
+    if config["processing"]["incrementalIndicators"]:
+        dout = incrementalIndicator(config, thisDat, indID, outFile[0], shared)
+    else:
+        dout = computeIndicator(config, thisDat, indID, shared)
+    helpers.writeNetCDF(config, dout, outFile[0], "indicators")
+    storeIncremental(config, dout, indID, outFile[0])
+
+
+def calculateFusedIndicators(config, inFile, outFile, indIDs):
+    """
+    Calculate fused indicators
 
+    Calculates several indicators from the same primary variable file in a single job.
+    The file is read once, intermediates that are common to several indicators (e.g.
+    seasonal subsets) are shared between them, and all of the outputs are evaluated
+    together as a single dask graph, so that each chunk of the input is only read once.
+    `outFile` gives the output file for each of the indicators in `indIDs`, in order.
+    """
+    # Read the dataset object back from disk. The data is chunked if it isn't already,
+    # so that the indicators are evaluated lazily and can be computed together
+    thisDat = helpers.setPrecision(config, helpers.readFile(inFile[0]))
+    if thisDat.chunks is None:
+        thisDat = thisDat.chunk({"time": "auto"})
+
+    # Setup each of the indicators and the writes, without computing anything. The
+    # monthly cube, if present, follows the primary variable
+    shared = {}
+    if len(inFile) > 1:
+        shared[("monthlyCube",)] = xr.open_dataset(inFile[1], chunks={})
+    writes = []
+    douts = []
+    for thisID, thisOutFile in zip(indIDs, outFile):
+        if config["processing"]["incrementalIndicators"]:
+            dout = incrementalIndicator(config, thisDat, thisID, thisOutFile, shared)
+        else:
+            dout = computeIndicator(config, thisDat, thisID, shared)
+        douts.append(dout)
+        writes.append(helpers.writeNetCDF(config, dout, thisOutFile, "indicators", compute=False))
+
+    # Now evaluate them all together
+    dask.compute(*writes)
+    for thisID, thisOutFile, dout in zip(indIDs, outFile, douts):
+        storeIncremental(config, dout, thisID, thisOutFile)
+
+
+def computeIndicator(config, thisDat, indID, shared=None):
+    """
+    Compute indicator
+
+    Sets up the calculation of a single indicator from the primary variable `thisDat`.
+    Intermediate results are stored in the dict `shared`, if supplied, so that they can
+    be reused by other indicators calculated from the same data. Returns the (lazy)
+    indicator, in the working precision. Indicators requesting several seasons are
+    returned with a `season` dimension.
+    """
     # Retrieve indicator information
     thisInd = config["indicators"][indID]
+    if shared is None:
+        shared = {}
+    theseSeasons = helpers.indicatorSeasons(config, thisInd)
+    if thisInd["time_binning"] not in ["periods", "years", "months"]:
+        sys.exit("Unknown time_binning method, '" + thisInd["time_binning"] + "'")
 
-    # Read the dataset object back from disk, depending on the configuration
-    thisDat = helpers.readFile(inFile[0])
-
-    # Filter by season first (should always work)
-    theseMonths = config["seasons"][thisInd["season"]]["months"]
-    datSeason = thisDat.sel(time=np.isin(thisDat.time.dt.month, theseMonths))
+    # Retrieve the statistic from the registry and apply the elementwise part, if
+    # there is one (e.g. threshold exceedance)
+    if thisInd["statistic"] not in indicatorStatistics:
+        sys.exit('Unknown indicator statistic, "' + thisInd["statistic"] + '"')
+    thisStat = indicatorStatistics[thisInd["statistic"]]
+    if thisStat["transform"] is None:
+        statKey = ("raw",)
+        datStat = thisDat
+    else:
+        statKey = (thisInd["statistic"], thisInd.get("threshold", ""))
+        if ("transform",) + statKey not in shared:
+            shared[("transform",) + statKey] = thisStat["transform"](thisDat, thisInd)
+        datStat = shared[("transform",) + statKey]
+    reduction = thisStat["reduction"]
 
-    # Time binning over periods
+    # Only the years covered by the periods are needed for period binning
     if thisInd["time_binning"] == "periods":
-        slices = []
-        for thisPeriod in config["periods"].values():
-            # Slice dataset
-            datPeriodSeason=helpers.timeslice(datSeason,thisPeriod["start"],thisPeriod["end"])
-            timebounds = pd.to_datetime(
-                [f"{thisPeriod['start']}-01-01", f"{thisPeriod['end']}-12-31"]
-            )
-            timestamp = timebounds.mean()
-            # If there is nothing left, we want a result all the same so that we
-            # can put it in the outputs. We copy the structure and populate
-            # it with NaNs
-            if datPeriodSeason.time.size == 0:
-                res = datSeason.isel(time=0)
-                res.data[:] = np.nan
-            # Apply the operator
-            elif thisInd["statistic"] == "mean":
-                res = datPeriodSeason.mean("time", keep_attrs=True)
+        periodTbl = pd.DataFrame(config["periods"].values())
+        periodTbl["start"] = periodTbl["start"].astype(int)
+        periodTbl["end"] = periodTbl["end"].astype(int)
+        yearRange = (periodTbl["start"].min(), periodTbl["end"].max())
+        datStat = helpers.timeslice(datStat, *yearRange)
+    else:
+        periodTbl = None
+        yearRange = None
+
+    # Apply the operator for each season
+    if (reduction == "quantile") and (thisInd["time_binning"] == "periods") \
+            and (config["processing"]["approximatePercentiles"] > 0):
+        # Approximate quantiles over periods are built up from sketches, a chunk at a time
+        seasonRes = [sketchBins(config, thisInd, datStat, thisSeason, periodTbl,
+                                shared, statKey + (yearRange,))
+                     for thisSeason in theseSeasons]
+    elif reduction == "quantile":
+        # Quantiles can't be built up from partial results, so each season is reduced
+        # separately
+        seasonRes = [quantileBins(config, thisInd, datStat, thisSeason, periodTbl,
+                                  shared, statKey + (yearRange,))
+                     for thisSeason in theseSeasons]
+    else:
+        # Seasons, periods and years can all overlap, so a time step can belong to more
+        # than one output. Rather than selecting and reducing each output in turn, which
+        # reads the data once for each, we reduce by year and month in a single grouped
+        # pass (flox is used for this by xarray, when available) and then combine the
+        # monthly partial results into the outputs. If a monthly cube is available, the
+        # partial results are taken directly from it instead
+        partKey = ("monthly", partialReductions[reduction]) + statKey + (yearRange,)
+        if partKey not in shared:
+            if (statKey == ("raw",)) and (("monthlyCube",) in shared):
+                shared[partKey] = cubePartials(shared[("monthlyCube",)],
+                                               partialReductions[reduction], yearRange)
             else:
-                sys.exit('Unknown indicator statistic, "' + ind["statistic"] + '"')
-            # Tidy output
-            res["periodID"] = thisPeriod["id"]
-            slices.append(res)
+                shared[partKey] = monthlyPartials(datStat, partialReductions[reduction])
+        seasonRes = [combineMonthly(config, thisInd, shared[partKey], reduction,
+                                    thisSeason, periodTbl)
+                     for thisSeason in theseSeasons]
+
+    # Combine the seasons
+    if helpers.isMultiSeason(thisInd):
+        dout = xr.concat(seasonRes, dim=pd.Index(theseSeasons, name="season"))
+    else:
+        dout = seasonRes[0]
 
-        # Convert list back into dataset
-        dout = xr.concat(slices, dim="periodID")
+    # Tidy output
+    dout = dout.astype(datStat.dtype)
+    if thisInd["time_binning"] == "periods":
+        dout = dout.transpose("periodID", ...)
         dout.periodID.attrs["name"] = "periodID"
         dout.periodID.attrs["description"] = (
             f"For period definitions see {config['configurationTables']['periods']}"
         )
-
-    # Time binning by defined units
-    elif thisInd["time_binning"] in ["years", "months"]:
-        # Then group by time. Could consider using groupby as an alternative
-        if thisInd["time_binning"] == "years":
-            datGroupped = datSeason.resample(time="YE", label="right")
-        elif thisInd["time_binning"] == "months":
-            datGroupped = datSeason.resample(time="ME", label="right")
-        else:
-            sys.exit("Shouldn't be here")
-
-        # Apply the operator
-        if thisInd["statistic"] == "mean":
-            dout = datGroupped.mean(["time"], keep_attrs=True)
-        else:
-            sys.exit('Unknown indicator statistic, "' + thisInd["statistic"] + '"')
-
-        # Round time to the middle of the month. This ensures that everything
-        # has an identical datetime, regardless of the calendar being used.
-        # Kudpos to ChatGPT for this little work around
-        # Note that we need to ensure cftime representation, for runs that
-        # go out paste 2262
-        dout["time"] = [cftime.DatetimeGregorian(x.dt.strftime("%Y"),x.dt.strftime("%m"),15)
-                                                for x in dout.time]
-
-    else:
-        sys.exit("Unknown time_binning method, '" + thisInd["time_binning"] + "'")
+    elif thisInd["time_binning"] == "months":
+        dout = trimMonths(config, thisInd, dout)
+    if "season" in dout.dims:
+        dout = dout.transpose(*[d for d in ["periodID", "time", "season"] if d in dout.dims], ...)
+    if thisInd["time_binning"] in ["years", "months"]:
+        dout = dout.transpose("time", ...)
 
     # Polish final product
     dout.name = "indicator"
@@ -101,5 +226,380 @@ def calculateIndicators(config, inFile, outFile, indID):
         if thiskey != "files":
             dout.attrs[thiskey] = thisInd[thiskey]
 
-    # Write out
-    dout.to_netcdf(outFile[0])
+    # Return in the working precision
+    return helpers.setPrecision(config, dout)
+
+
+def trimMonths(config, thisInd, dout):
+    # Only keep the range of months covered by the seasons, as if the data had been
+    # filtered by season before being binned
+    theseMonths = [m for thisSeason in helpers.indicatorSeasons(config, thisInd)
+                   for m in config["seasons"][thisSeason]["months"]]
+    inSeason = np.where(np.isin(dout[helpers.binIndexCoord].values % 12 + 1, theseMonths))[0]
+    if inSeason.size == 0:
+        return dout.isel(time=slice(0, 0))
+    return dout.isel(time=slice(inSeason.min(), inSeason.max() + 1))
+
+
+def indicatorSignature(config, thisInd):
+    # Hash of the configuration that affects all of the values of an indicator. If
+    # any of this changes, an incremental update is not possible
+    sigCfg = {"indicator": {k: v for k, v in thisInd.items() if k != "files"},
+              "seasons": {s: config["seasons"][s] for s in helpers.indicatorSeasons(config, thisInd)},
+              "periods": config["periods"] if thisInd["time_binning"] == "periods" else None,
+              "precision": config["processing"]["precision"],
+              "encoding": config["processing"]["encoding"]}
+    return hashlib.sha1(json.dumps(sigCfg, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def incrementalCacheFile(config, indID, outFile):
+    # Last indicator output, kept in the cache directory. Snakemake removes the outputs
+    # of a job before it is rerun, so the output itself can't be used
+    return os.path.join(config["dirs"]["cache"], "indicators", indID, os.path.basename(outFile))
+
+
+def incrementalIndicator(config, thisDat, indID, outFile, shared=None):
+    """
+    Compute indicator incrementally
+
+    Sets up the calculation of a single indicator in the same manner as
+    computeIndicator(), but reuses the previous result for this output where possible.
+    The hashes of the input files covering each year, recorded in the primary
+    variable, are compared with those stored with the previous result, and only the
+    time bins covering years that have changed (or been added or removed) are
+    recalculated and patched into it. The indicator is calculated in full if there is
+    no previous result, or if the configuration of the indicator has changed.
+    """
+    thisInd = config["indicators"][indID]
+    newHashes = json.loads(thisDat.attrs.get(helpers.inputHashesAttr, "{}"))
+    signature = indicatorSignature(config, thisInd)
+    cacheFile = incrementalCacheFile(config, indID, outFile)
+
+    # Retrieve the previous result. Packed outputs would lose precision each time they
+    # are patched, so are always calculated in full
+    cached = None
+    if (len(newHashes) > 0) and os.path.exists(cacheFile) \
+            and not config["processing"]["encoding"]["packing"]:
+        cached = xr.load_dataarray(cacheFile, use_cftime=True).drop_encoding()
+        if cached.attrs.get("indicatorSignature") != signature:
+            cached = None
+    # The output can share its data with the cached result (see storeIncremental()),
+    # so an existing output is removed rather than overwritten in place
+    if os.path.exists(outFile):
+        os.remove(outFile)
+
+    # Calculate
+    if cached is None:
+        dout = computeIndicator(config, thisDat, indID, shared)
+    else:
+        oldHashes = json.loads(cached.attrs[helpers.inputHashesAttr])
+        changedYears = sorted({int(y) for y, h in newHashes.items() if oldHashes.get(y) != h}
+                              | {int(y) for y in oldHashes.keys() if y not in newHashes})
+        dout = patchIndicator(config, thisDat, indID, cached, changedYears, shared)
+
+    # Record the hashes against the result
+    if len(newHashes) > 0:
+        dout.attrs[helpers.inputHashesAttr] = json.dumps(newHashes)
+        dout.attrs["indicatorSignature"] = signature
+    return dout
+
+
+def patchIndicator(config, thisDat, indID, cached, changedYears, shared=None):
+    # Recalculate the time bins of an indicator covering the changed years, and patch
+    # them into the previous result
+    thisInd = config["indicators"][indID]
+    if shared is None:
+        shared = {}
+    if len(changedYears) == 0:
+        return cached
+
+    if thisInd["time_binning"] == "periods":
+        # Only the periods covering the changed years are recalculated
+        theseIDs = [thisID for thisID, thisPeriod in config["periods"].items()
+                    if any(int(thisPeriod["start"]) <= y <= int(thisPeriod["end"])
+                           for y in changedYears)]
+        if len(theseIDs) == 0:
+            return cached
+        subConfig = {**config, "periods": {k: config["periods"][k] for k in theseIDs}}
+        newDat = computeIndicator(subConfig, thisDat, indID, shared)
+        keepDat = cached.sel(periodID=[p for p in cached.periodID.values if p not in theseIDs])
+        # The IDs are set as plain strings in both, as the index types can differ
+        dout = xr.concat([d.assign_coords(periodID=[str(p) for p in d.periodID.values])
+                          for d in [keepDat, newDat]], dim="periodID")
+        dout = dout.sel(periodID=list(config["periods"].keys()))
+        dout.periodID.attrs = newDat.periodID.attrs
+
+    else:
+        # Year and month bins each depend only on the data of a single year, so only the
+        # data for the changed years is needed. Intermediates calculated from this subset
+        # are kept apart from those for the full data set
+        subShared = shared.setdefault(("years",) + tuple(changedYears), {})
+        inChanged = np.isin(helpers.timeIndex(thisDat, "year"), changedYears)
+        theseParts = [helpers.binIndexToDim(cached).isel(
+            {helpers.binIndexCoord: ~np.isin(cached[helpers.binIndexCoord].values // 12, changedYears)})]
+        if inChanged.any():
+            newDat = computeIndicator(config, thisDat.isel(time=inChanged), indID, subShared)
+            theseParts.append(helpers.binIndexToDim(newDat))
+        dout = xr.concat(theseParts, dim=helpers.binIndexCoord).sortby(helpers.binIndexCoord)
+        if thisInd["time_binning"] == "months":
+            # Months outside of the seasons are included as NaNs, within the range covered
+            binIdx = dout[helpers.binIndexCoord].values
+            dout = dout.reindex({helpers.binIndexCoord:
+                                 np.arange(binIdx.min(), binIdx.max() + 1, dtype=binIdx.dtype)})
+        dout = helpers.binIndexToTime(dout).transpose(*cached.dims)
+        if thisInd["time_binning"] == "months":
+            dout = trimMonths(config, thisInd, dout)
+
+    dout.attrs = cached.attrs
+    return dout
+
+
+def storeIncremental(config, dout, indID, outFile):
+    # Keep an indicator output that carries input hashes, for use in subsequent
+    # incremental updates. The output is hard linked into the cache, so that no extra
+    # space is used, and only copied where the file system doesn't allow this. We
+    # write to a temporary file first and then move it into place, to avoid problems
+    # with concurrent jobs
+    if helpers.inputHashesAttr not in dout.attrs:
+        return
+    cacheFile = incrementalCacheFile(config, indID, outFile)
+    os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+    tmpFile = f"{cacheFile}.{os.getpid()}"
+    try:
+        os.link(outFile, tmpFile)
+    except OSError:
+        shutil.copyfile(outFile, tmpFile)
+    os.replace(tmpFile, cacheFile)
+
+
+def monthlyPartials(datStat, how):
+    # Reduce the data by year and month, labelled as year*12 + month - 1, in a single
+    # grouped pass. Partial sums are always accumulated in double precision, as they are
+    # combined again afterwards, and are accompanied by the counts of valid values
+    ymLabels = xr.DataArray(helpers.timeIndex(datStat, "year").astype(int) * 12
+                            + helpers.timeIndex(datStat, "month") - 1,
+                            dims="time", name="yearMonth")
+    if how == "sum":
+        return (datStat.groupby(ymLabels).sum("time", dtype="float64"),
+                datStat.notnull().groupby(ymLabels).sum("time"))
+    return (getattr(datStat.groupby(ymLabels), how)("time"),)
+
+
+def cubePartials(cube, how, yearRange):
+    # Monthly partial results taken from a monthly cube, limited to the range of years
+    # used, if given
+    if yearRange is not None:
+        years = cube["yearMonth"].values // 12
+        cube = cube.isel(yearMonth=(years >= yearRange[0]) & (years <= yearRange[1]))
+    if how == "sum":
+        return (cube["sum"], cube["count"])
+    return (cube[how],)
+
+
+def buildMonthlyCube(config, inFile, outFile):
+    """
+    Build monthly cube
+
+    Reduces a primary variable to monthly aggregates (the sum, the count of valid
+    values, the minimum and the maximum), which are written together to a single file
+    in the cache directory. Indicators that can be derived from these aggregates are
+    then calculated from the cube, rather than from the daily data. The aggregates are
+    calculated together, in a single pass over the data, and are stored in full
+    precision, without the output encoding policy.
+    """
+    thisDat = helpers.setPrecision(config, helpers.readFile(inFile[0]))
+    if thisDat.chunks is None:
+        thisDat = thisDat.chunk({"time": "auto"})
+    sums, counts = monthlyPartials(thisDat, "sum")
+    cube = xr.Dataset({"sum": sums,
+                       "count": counts,
+                       "min": monthlyPartials(thisDat, "min")[0],
+                       "max": monthlyPartials(thisDat, "max")[0]})
+    cube.to_netcdf(outFile[0])
+
+
+def setBinTimes(res, binDim, yearMonths):
+    # Replace a dimension of integer bins by the normalised time axis, and tag it with
+    # the calendar-independent bin index (year*12 + month - 1), which later stages can
+    # align on without decoding the times
+    yearMonths = np.asarray(yearMonths, dtype=np.int32)
+    res = res.drop_vars(binDim).rename({binDim: "time"})
+    return res.assign_coords({"time": helpers.binTimes(yearMonths),
+                              helpers.binIndexCoord: ("time", yearMonths)})
+
+
+def finalisePartials(partials, reduction):
+    # Convert reduced partial results into the final statistic. Bins without any data
+    # are returned as NaNs, so that we still get a result to put in the outputs
+    if partialReductions[reduction] == "sum":
+        sums, counts = partials
+        counts = counts.where(counts > 0)
+        return sums / counts if reduction == "mean" else sums.where(counts.notnull())
+    return partials[0]
+
+
+def combineMonthly(config, thisInd, partials, reduction, thisSeason, periodTbl):
+    # Combine monthly partial results into the time bins of an indicator, for a single
+    # season
+    how = partialReductions[reduction]
+    ymValues = partials[0].yearMonth.values
+    inSeason = np.isin(ymValues % 12 + 1, config["seasons"][thisSeason]["months"])
+    if thisInd["time_binning"] == "periods":
+        slices = []
+        for idx, rw in periodTbl.iterrows():
+            inPeriod = inSeason & (ymValues // 12 >= rw["start"]) & (ymValues // 12 <= rw["end"])
+            if inPeriod.any():
+                slices.append(finalisePartials(
+                    [getattr(p.isel(yearMonth=inPeriod), how)("yearMonth") for p in partials],
+                    reduction))
+            else:
+                slices.append(xr.full_like(partials[0].isel(yearMonth=0, drop=True),
+                                           np.nan, dtype="float64"))
+        res = xr.concat(slices, dim=pd.Index(list(periodTbl["id"]), name="periodID"))
+    elif thisInd["time_binning"] == "years":
+        yearLabels = xr.DataArray(ymValues[inSeason] // 12, dims="yearMonth", name="year")
+        res = finalisePartials(
+            [getattr(p.isel(yearMonth=inSeason).groupby(yearLabels), how)("yearMonth")
+             for p in partials],
+            reduction)
+        res = setBinTimes(res, "year", res.year.values * 12 + 11)
+    elif thisInd["time_binning"] == "months":
+        res = finalisePartials(partials, reduction)
+        res = res.where(xr.DataArray(inSeason, dims="yearMonth"))
+        res = setBinTimes(res, "yearMonth", ymValues)
+    return res
+
+
+def quantileBins(config, thisInd, datStat, thisSeason, periodTbl, shared, statKey):
+    # Calculate a quantile over the time bins of an indicator, for a single season.
+    # Quantiles need the full time series in a single chunk
+    thisQuantile = float(thisInd["percentile"]) / 100
+    if ("season", thisSeason) + statKey not in shared:
+        datSeason = datStat.isel(time=np.isin(helpers.timeIndex(datStat, "month"),
+                                              config["seasons"][thisSeason]["months"]))
+        if datSeason.chunks is not None:
+            datSeason = datSeason.chunk({d: (-1 if d == "time" else "auto") for d in datSeason.dims})
+        shared[("season", thisSeason) + statKey] = datSeason
+    datSeason = shared[("season", thisSeason) + statKey]
+
+    if thisInd["time_binning"] == "periods":
+        # Each period is reduced separately
+        slices = []
+        for idx, rw in periodTbl.iterrows():
+            datPeriod = helpers.timeslice(datSeason, rw["start"], rw["end"])
+            if datPeriod.time.size == 0:
+                slices.append(xr.full_like(datSeason.isel(time=0, drop=True), np.nan))
+            else:
+                slices.append(datPeriod.quantile(thisQuantile, dim="time").drop_vars("quantile"))
+        res = xr.concat(slices, dim=pd.Index(list(periodTbl["id"]), name="periodID"))
+    else:
+        # Group by year or month, with the bins labelled as year*12 + month - 1. Yearly
+        # bins are labelled by their December
+        years = helpers.timeIndex(datSeason, "year").astype(int)
+        if thisInd["time_binning"] == "months":
+            labels, step = years * 12 + helpers.timeIndex(datSeason, "month") - 1, 1
+        else:
+            labels, step = years * 12 + 11, 12
+        res = datSeason.groupby(xr.DataArray(labels, dims="time", name="bin")).quantile(
+            thisQuantile, dim="time").drop_vars("quantile")
+        # Bins without any data are included as NaNs
+        res = res.reindex(bin=np.arange(labels.min(), labels.max() + 1, step))
+        res = setBinTimes(res, "bin", res.bin.values)
+    return res
+
+
+def sketchBins(config, thisInd, datStat, thisSeason, periodTbl, shared, statKey):
+    # Calculate an approximate quantile over each of the periods of an indicator, for a
+    # single season. Each chunk of the time series is summarised by a histogram of the
+    # values in each grid cell (a sketch), spanning the range of the data in that cell.
+    # Sketches can be merged by summing them, so the chunks are processed independently
+    # and the memory required doesn't depend on the length of the periods. The range of
+    # each cell is needed before the chunks can be processed, and is calculated first,
+    # in a separate pass, so that the chunks don't need to be held in memory until then
+    thisQuantile = float(thisInd["percentile"]) / 100
+    nBins = int(np.ceil(1 / config["processing"]["approximatePercentiles"]))
+    if ("sketchSeason", thisSeason) + statKey not in shared:
+        datSeason = datStat.isel(time=np.isin(helpers.timeIndex(datStat, "month"),
+                                              config["seasons"][thisSeason]["months"]))
+        if datSeason.chunks is None:
+            datSeason = datSeason.chunk("auto")
+        lo, hi = dask.compute(datSeason.min("time"), datSeason.max("time"))
+        shared[("sketchSeason", thisSeason) + statKey] = (datSeason, lo, hi)
+    datSeason, lo, hi = shared[("sketchSeason", thisSeason) + statKey]
+
+    slices = []
+    for idx, rw in periodTbl.iterrows():
+        datPeriod = helpers.timeslice(datSeason, rw["start"], rw["end"])
+        if datPeriod.time.size == 0:
+            slices.append(xr.full_like(lo, np.nan, dtype="float64"))
+            continue
+        counts = xr.apply_ufunc(histogramSketch, datPeriod, lo, hi,
+                                kwargs={"nBins": nBins},
+                                input_core_dims=[["time"], [], []],
+                                output_core_dims=[["bin"]],
+                                dask="allowed")
+        slices.append(xr.apply_ufunc(sketchQuantile, counts, lo, hi,
+                                     kwargs={"q": thisQuantile},
+                                     input_core_dims=[["bin"], [], []],
+                                     dask="allowed"))
+    return xr.concat(slices, dim=pd.Index(list(periodTbl["id"]), name="periodID"))
+
+
+def histogramSketch(dat, lo, hi, nBins):
+    # Sum the histograms of each time chunk of the dask array `dat`, with time as the
+    # last dimension. Returns the counts in each bin, as a new last dimension
+    lo, hi = [dask.array.from_array(np.asarray(x), chunks=dat.chunks[:-1])[..., None]
+              for x in [lo, hi]]
+    return dask.array.map_blocks(blockHistogram, dat, lo, hi,
+                                 nBins=nBins,
+                                 new_axis=dat.ndim,
+                                 chunks=dat.chunks[:-1] + ((1,) * dat.numblocks[-1], (nBins,)),
+                                 dtype=np.int32).sum(axis=-2, dtype=np.int32)
+
+
+def blockHistogram(block, lo, hi, nBins):
+    # Histogram of the values in each cell of a single block, with time as the last
+    # dimension. All cells are counted in a single call to bincount, using a flat index
+    # of cell and bin. Operations are done in place where possible, to limit the
+    # temporary arrays needed
+    width = np.where(hi > lo, (hi - lo) / nBins, 1.0)
+    flatIdx = np.subtract(block, lo, dtype=np.float64)
+    flatIdx /= width
+    np.floor(flatIdx, out=flatIdx)
+    np.clip(flatIdx, 0, nBins - 1, out=flatIdx)
+    nCells = int(np.prod(block.shape[:-1]))
+    flatIdx += (np.arange(nCells) * nBins).reshape(block.shape[:-1] + (1,))
+    counts = np.bincount(flatIdx[np.isfinite(flatIdx)].astype(np.int64), minlength=nCells * nBins)
+    return counts.astype(np.int32).reshape(block.shape[:-1] + (1, nBins))
+
+
+def sketchQuantile(counts, lo, hi, q):
+    # Quantile from the summed histograms, with bins as the last dimension
+    lo, hi = [dask.array.from_array(np.asarray(x), chunks=counts.chunks[:-1])[..., None]
+              for x in [lo, hi]]
+    return dask.array.map_blocks(blockQuantile, counts, lo, hi,
+                                 q=q, drop_axis=counts.ndim - 1, dtype=np.float64)
+
+
+def blockQuantile(counts, lo, hi, q):
+    # Quantile from the histogram of each cell, with bins as the last dimension. The
+    # same definition is used as in the exact calculation i.e. linear interpolation
+    # between the two values either side. Each of these values is located in its bin,
+    # assuming that the values in a bin are spread evenly across it, so that it lies
+    # within one bin width of the true value
+    nBins = counts.shape[-1]
+    cumCounts = np.cumsum(counts, axis=-1)
+    n = cumCounts[..., -1:]
+    width = np.where(hi > lo, (hi - lo) / nBins, 0.0)
+    rank = q * np.maximum(n - 1, 0)
+
+    def orderStatistic(j):
+        k = np.argmax(cumCounts > j, axis=-1)[..., None]
+        kCounts = np.take_along_axis(counts, k, axis=-1)
+        frac = (j - np.take_along_axis(cumCounts, k, axis=-1) + kCounts + 0.5) / np.maximum(kCounts, 1)
+        return lo + (k + frac) * width
+
+    below = orderStatistic(np.floor(rank))
+    above = orderStatistic(np.ceil(rank))
+    res = np.clip(below + (rank - np.floor(rank)) * (above - below), lo, hi)
+    return np.where(n > 0, res, np.nan)[..., 0]
@@ -0,0 +1,159 @@
+"""
+#Setup for debugging with VS Code
+import os
+print(os.getcwd())
+os.chdir("..")
+import KAPy
+os.chdir("..")
+config=KAPy.getConfig("./config/config.yaml")
+import glob
+inFiles=glob.glob(config['inputs']['CORDEX-tas-44']['path'])
+"""
+
+# Maintains an on-disk inventory of the input files, based on header information only
+import os
+import sys
+import json
+import hashlib
+import cftime
+import pandas as pd
+import xarray as xr
+
+# Reference units used to store the time range of each file as numbers. Numbers are
+# only ever compared between files that share a calendar
+inventoryTimeUnits = "days since 1850-01-01"
+
+
+def scanInputFile(thisPath):
+    """
+    Scan an input file
+
+    Reads the header of a single input file and returns a dict describing its contents:
+    the time range and calendar, the number of time steps, the grid shape, the names
+    of the variables and the size in bytes of their values, once decoded. Only the
+    first and last time steps are decoded.
+    """
+    with xr.open_dataset(thisPath, decode_times=False, chunks={}) as ds:
+        if "time" not in ds.variables:
+            sys.exit(f"Cannot find a time coordinate in input file '{thisPath}'.")
+        timeVar = ds["time"]
+        thisCal = timeVar.attrs.get("calendar", "standard")
+        tBounds = cftime.num2date(timeVar.values[[0, -1]],
+                                  timeVar.attrs["units"],
+                                  calendar=thisCal)
+        tBoundsNum = cftime.date2num(tBounds, inventoryTimeUnits, calendar=thisCal)
+        # Variables are those that vary in time, excluding bounds
+        theseVars = [v for v in ds.data_vars
+                     if ("time" in ds[v].dims) and ("bnds" not in ds[v].dims)]
+        gridDims = {d: ds.sizes[d] for v in theseVars for d in ds[v].dims if d != "time"}
+        rtn = {
+            "path": thisPath,
+            "varNames": ",".join(theseVars),
+            "gridShape": ",".join([f"{d}={n}" for d, n in gridDims.items()]),
+            "itemSize": max([ds[v].dtype.itemsize for v in theseVars], default=8),
+            "calendar": thisCal,
+            "nTime": timeVar.size,
+            "tStart": tBounds[0].isoformat(),
+            "tEnd": tBounds[1].isoformat(),
+            "tStartNum": float(tBoundsNum[0]),
+            "tEndNum": float(tBoundsNum[1]),
+        }
+    return rtn
+
+
+def getInventory(config, inFiles):
+    """
+    Get the inventory of input files
+
+    Returns a table describing each of the files in `inFiles`, in the same order, based
+    on the inventory index stored in the cache directory. Files that are new, or that
+    have been modified since they were last scanned, are (re)scanned and the index on
+    disk is updated.
+    """
+    indexFile = os.path.join(config["dirs"]["cache"], "inventory.parquet")
+    if os.path.exists(indexFile):
+        invTbl = pd.read_parquet(indexFile).set_index("path", drop=False)
+    # Indices written by earlier versions lack some of the columns, and are rebuilt
+    if (not os.path.exists(indexFile)) or ("itemSize" not in invTbl.columns):
+        invTbl = pd.DataFrame(columns=["path", "mtime", "size"]).set_index("path", drop=False)
+
+    # Identify files that need to be scanned
+    theseStats = {f: os.stat(f) for f in inFiles}
+    staleFiles = [f for f, st in theseStats.items()
+                  if (f not in invTbl.index)
+                  or (invTbl.at[f, "mtime"] != st.st_mtime)
+                  or (invTbl.at[f, "size"] != st.st_size)]
+
+    # Scan and update the index. We write to a temporary file first and then move
+    # it into place, to avoid problems with concurrent jobs
+    if len(staleFiles) > 0:
+        newTbl = pd.DataFrame([{**scanInputFile(f),
+                                "mtime": theseStats[f].st_mtime,
+                                "size": theseStats[f].st_size} for f in staleFiles])
+        newTbl = newTbl.set_index("path", drop=False)
+        invTbl = invTbl.drop(index=staleFiles, errors="ignore")
+        invTbl = newTbl if invTbl.empty else pd.concat([invTbl, newTbl])
+        os.makedirs(os.path.dirname(indexFile), exist_ok=True)
+        tmpFile = f"{indexFile}.{os.getpid()}"
+        invTbl.reset_index(drop=True).to_parquet(tmpFile, index=False)
+        os.replace(tmpFile, indexFile)
+
+    return invTbl.loc[list(inFiles)]
+
+
+def checkInventory(invTbl, pvPath):
+    """
+    Check time coverage
+
+    Checks that the files making up a single primary variable share a calendar and
+    form a continuous time series. Overlapping files are treated as an error, while
+    gaps generate a warning.
+    """
+    if invTbl["calendar"].nunique() > 1:
+        sys.exit(f"Multiple calendars found in input files for '{pvPath}': "
+                 + f"{list(invTbl['calendar'].unique())}.")
+    thisTbl = invTbl.sort_values("tStartNum")
+    prevEnd = thisTbl["tEndNum"].shift()
+    # Overlaps
+    overlaps = thisTbl["tStartNum"] <= prevEnd
+    if overlaps.any():
+        sys.exit(f"Overlapping time ranges found in input files for '{pvPath}': "
+                 + f"{list(thisTbl['path'][overlaps])}.")
+    # Gaps are identified relative to the typical time step in the files, which
+    # allows for the varying length of months
+    timeStep = ((thisTbl["tEndNum"] - thisTbl["tStartNum"]) /
+                (thisTbl["nTime"] - 1)).median()
+    gaps = (thisTbl["tStartNum"] - prevEnd) > 1.5 * timeStep
+    if gaps.any():
+        print(f"Warning: gaps found in the time coverage of input files for '{pvPath}' "
+              + f"before {list(thisTbl['path'][gaps])}.")
+
+
+def inputYearHashes(config, invTbl, inpID):
+    """
+    Hash inputs by year
+
+    Returns a dict giving a content hash for each year covered by the files in the
+    inventory table `invTbl`. The hash of a year is built from the path, modification
+    time and size of each file that overlaps it, together with the configuration of
+    the input. Extending the record, or replacing one of the files, therefore only
+    changes the hashes of the years that are affected.
+    """
+    # Configuration that affects the values of every year
+    cfgSignature = json.dumps({"input": config["inputs"][inpID],
+                               "cutouts": config["cutouts"],
+                               "precision": config["processing"]["precision"]},
+                              sort_keys=True, default=str)
+    thisTbl = invTbl.reset_index(drop=True).sort_values("path")
+    thisTbl["startYear"] = [int(x.split("-")[0]) for x in thisTbl["tStart"]]
+    thisTbl["endYear"] = [int(x.split("-")[0]) for x in thisTbl["tEnd"]]
+    yearHashes = {}
+    for thisYear in range(thisTbl["startYear"].min(), thisTbl["endYear"].max() + 1):
+        theseFiles = thisTbl[(thisTbl["startYear"] <= thisYear) & (thisTbl["endYear"] >= thisYear)]
+        if theseFiles.empty:
+            continue
+        thisHash = hashlib.sha1(cfgSignature.encode())
+        for idx, rw in theseFiles.iterrows():
+            thisHash.update(f"|{rw['path']}|{rw['mtime']}|{rw['size']}".encode())
+        yearHashes[str(thisYear)] = thisHash.hexdigest()
+    return yearHashes
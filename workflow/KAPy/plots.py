@@ -64,8 +64,11 @@ def makeBoxplot(config, indID, srcFiles, outFile=None):
 
     # Now merge into dataframe and pivot for plotting
     pltLong = pd.merge(datdf, ptileTbl, on="percentiles", how="left")
+    # Multi-season indicators are split into panels by season
+    hasSeasons = "season" in datdf.columns
     pltDatWide = pltLong.pivot_table(
-        index=["lbl", "periodID"], columns="ptileLbl", values="mean"
+        index=["lbl", "periodID"] + (["season"] if hasSeasons else []),
+        columns="ptileLbl", values="mean"
     ).reset_index()
 
     # Now plot
@@ -94,6 +97,8 @@ def makeBoxplot(config, indID, srcFiles, outFile=None):
         + theme_bw()
         + theme(legend_position="bottom", panel_grid_major_x=element_blank())
     )
+    if hasSeasons:
+        p = p + facet_wrap("~season")
 
     # Output
     if outFile is not None:
@@ -126,6 +131,9 @@ def makeSpatialplot(config, indID, srcFiles, outFile=None):
     pltDat = pd.concat(datdf)
     pltDat['lbl']=[ rw['source'] + "-" + rw['experiment'] if rw['experiment']!='no-expt' else rw['source']
                   for idx,rw in pltDat.iterrows()]
+    #Multi-season indicators get a column per season as well
+    if 'season' in pltDat.columns:
+        pltDat['lbl']=pltDat['lbl'] + "\n" + pltDat['season']
 
     #Setup period labelling
     periodTbl = pd.DataFrame.from_dict(config["periods"], orient="index")
@@ -209,6 +217,9 @@ def makeLineplot(config, indID, srcFiles, outFile=None):
         + scale_x_datetime(date_labels="%Y")
         + theme(legend_position="bottom")
     )
+    # Multi-season indicators are split into panels by season
+    if "season" in pltDat.columns:
+        p = p + facet_wrap("~season")
     # Output
     if outFile is not None:
         p.save(outFile[0],
@@ -21,7 +21,14 @@ import xarray as xr
 import pickle
 import sys
 import importlib
-from cdo import Cdo
+import contextlib
+import dask
+import numpy as np
+import json
+import os
+from . import inventory
+from . import references
+from . import helpers
 
 
 def buildPrimVar(config, inFiles, outFile, inpID):
@@ -29,26 +36,47 @@ def buildPrimVar(config, inFiles, outFile, inpID):
     Build the data object
 
     Build the set of input files into a single xarray-based dataset object
-    and write it out, either as a NetCDF file or as a pickle.
+    and write it out, either as a NetCDF file, a pickle or a Zarr store.
     """
     # Get input configuration
     thisInp = config["inputs"][inpID]
 
-    # Make dataset object using xarray lazy load approach.
-    # Apply a manual sort ensures that the time axis is correct
-    # Use the join="override" argument to handle the case where
-    # there are small numerical differences in the values of the
-    # coordinates - in this case, we take the coordinates from the first file
-    dsIn =xr.open_mfdataset(inFiles,
-                            combine='nested',
-                            use_cftime=True, 
-                            join="override", 
-                            concat_dim='time')
-    dsIn=dsIn.sortby('time')
+    # In streaming mode, the input is read in blocks of a fixed number of time steps
+    # rather than one file at a time
+    timeBlock = config['processing']['streamingTimeBlock']
+    streaming = timeBlock > 0
+
+    # If we are using virtual references, the input is a single reference
+    # index that has already been built over the input files
+    if config['processing']['virtualReferences']:
+        dsIn = helpers.openReference(inFiles[0],
+                                     chunks={'time': timeBlock} if streaming else {})
+
+    else:
+        # Put the files in time order, based on the input inventory
+        invTbl = inventory.getInventory(config, inFiles)
+        inFiles = list(invTbl.sort_values("tStartNum")["path"])
+
+        # Make dataset object using xarray lazy load approach.
+        # Use the join="override" argument to handle the case where
+        # there are small numerical differences in the values of the
+        # coordinates - in this case, we take the coordinates from the first file
+        dsIn =xr.open_mfdataset(inFiles,
+                                combine='nested',
+                                use_cftime=True, 
+                                join="override", 
+                                concat_dim='time',
+                                chunks={'time': timeBlock} if streaming else None)
+
+    # Apply a manual sort to ensure that the time axis is correct. This
+    # is only needed if the files themselves are not ordered internally
+    if not dsIn.indexes['time'].is_monotonic_increasing:
+        dsIn=dsIn.sortby('time')
 
     # Select the desired variable and rename it
     ds = dsIn.rename({thisInp["internalVarName"]: thisInp["varID"]})
     da = ds[thisInp["varID"]]  # Convert to dataarray
+    da = helpers.setPrecision(config, da)
 
     # Drop degenerate dimensions. If any remain, throw an error
     da = da.squeeze(drop=True)
@@ -71,29 +99,11 @@ def buildPrimVar(config, inFiles, outFile, inpID):
 
     #Apply cutout functionality
     if config["cutouts"]["method"] == "lonlatbox":
-        # The processing chain here is to first take
-        # a slide, and then do a cdo cutoout on it. This
-        # can be used as a mask on the xarray object - this
-        # way we can maintain the lazy-loading and storage benefits
-        # associated with pickling
-        
-        # Extract first time step. This avoids having to work
-        # with the entire dataset
-        firstTS=da.isel(time=0)
-
-        # Do cutouts using cdo sellonlatbox. Make sure that we
-        # return a dataarray and not a dataset
-        cdo = Cdo()
-        cutoutMask = cdo.sellonlatbox(
-            config["cutouts"]["xmin"],
-            config["cutouts"]["xmax"],
-            config["cutouts"]["ymin"],
-            config["cutouts"]["ymax"],
-            input=firstTS,
-            returnXArray=thisInp["varID"])
-        
-        # Apply masking to data array object
-        da=da.where(cutoutMask.notnull(),drop=True)
+        # The cutout is expressed as a window of integer indices along each
+        # of the spatial dimensions. Applying it with isel() means that only
+        # the window is ever read from disk, while maintaining the lazy-loading
+        # and storage benefits associated with pickling
+        da = applyCutout(config, da, thisInp["gridID"])
 
     elif config["cutouts"]["method"] != "none":
         #problem
@@ -109,9 +119,160 @@ def buildPrimVar(config, inFiles, outFile, inpID):
     #     ppFn = getattr(thisModule, thisInp["importScriptFunction"])
     #     da = ppFn(da)  # Assume no input arguments
 
+    # Attach the integer time index
+    da = helpers.addTimeIndex(da)
+
+    # For incremental calculation of the indicators, record a hash of the input
+    # files covering each year, so that the years that have changed can be identified
+    if config['processing']['incrementalIndicators']:
+        if config['processing']['virtualReferences']:
+            invTbl = inventory.getInventory(config, references.referencedFiles(inFiles[0]))
+        da.attrs[helpers.inputHashesAttr] = json.dumps(
+            inventory.inputYearHashes(config, invTbl, inpID))
+
+    # When streaming, the time blocks are read, processed and appended to the
+    # output one at a time using the synchronous dask scheduler. Peak memory use is 
+    # then set by the size of a block, rather than by the length of the record
+    if streaming:
+        da = da.chunk({'time': timeBlock})
+        daskCfg = dask.config.set(scheduler='synchronous')
+    else:
+        daskCfg = contextlib.nullcontext()
+
     # Write the dataset object to disk, depending on the configuration
-    if config['processing']['picklePrimaryVariables']:
-        with open(outFile[0],'wb') as f:
-            pickle.dump(da,f,protocol=-1)
+    pvFormat = config['processing']['primaryVariableFormat']
+    with daskCfg:
+        if pvFormat == 'pickle':
+            with open(outFile[0],'wb') as f:
+                pickle.dump(da,f,protocol=-1)
+        elif pvFormat == 'netcdf':
+            helpers.writeNetCDF(config, da, outFile[0], "variables")
+        elif pvFormat == 'zarr':
+            # Rechunk to the configured layout. Dimensions that are not specified
+            # are kept whole in each chunk. The encoding inherited from the source 
+            # NetCDF files (chunksizes, zlib etc) is not valid for zarr and is dropped,
+            # so that the zarr default compressor is used instead
+            chunkCfg = config['processing']['primaryVariableChunks']
+            da = da.chunk({d: chunkCfg.get(d, -1) for d in da.dims})
+            da.encoding = {}
+            da.to_dataset().to_zarr(outFile[0],
+                                    mode='w',
+                                    consolidated=True)
+        else:
+            sys.exit(f"Unsupported primary variable format '{pvFormat}'.")
+
+
+
+def lonLatCoords(da, gridID):
+    # Names of the longitude and latitude coordinates, found either by name or by
+    # standard name
+    def findCoord(theseNames):
+        for thisCoord in da.coords.values():
+            if (thisCoord.name in theseNames) or \
+               (thisCoord.attrs.get("standard_name") in theseNames):
+                return thisCoord.name
+        sys.exit(f"Cannot find a coordinate matching {theseNames} for cutout of '{gridID}'.")
+    return findCoord(["lon", "longitude"]), findCoord(["lat", "latitude"])
+
+
+def cutoutMask(config, da, gridID):
+    # Cells inside the cutout box. Longitudes are handled relative to the western
+    # boundary, so that it doesn't matter whether the grid runs from -180 to 180 or
+    # 0 to 360.
+    thisBox = config["cutouts"]
+    lon, lat = xr.broadcast(*[da[c] for c in lonLatCoords(da, gridID)])
+    boxWidth = thisBox["xmax"] - thisBox["xmin"]
+    if boxWidth >= 360:
+        inLon = xr.ones_like(lon, dtype=bool)
     else:
-        da.to_netcdf(outFile[0])
+        inLon = ((lon - thisBox["xmin"]) % 360) <= boxWidth
+    inLat = (lat >= thisBox["ymin"]) & (lat <= thisBox["ymax"])
+    return inLon & inLat
+
+
+def getCutoutWindow(config, da, gridID):
+    """
+    Get cutout index window
+
+    Determines the window of integer indices along each spatial dimension of
+    `da` that covers the configured lonlatbox cutout, and returns it as a dict of
+    [start, stop] pairs. Cells are selected based on their longitude and latitude
+    coordinates, in the same manner as the CDO `sellonlatbox` operator, so
+    curvilinear grids are cut to the bounding box in index space. Where the box
+    crosses the seam of a 1-D longitude axis, the window wraps around the end of
+    the axis, and start is then greater than stop. As all inputs sharing a gridID
+    share the same window, it is calculated only once and cached in the cache
+    directory.
+    """
+    cutCfg = config["cutouts"]
+    thisBox = {k: cutCfg[k] for k in ["xmin", "xmax", "ymin", "ymax"]}
+    cacheFile = os.path.join(config["dirs"]["cache"], "cutouts", f"{gridID}.json")
+
+    # Use the cached window if it is valid for this box and this grid
+    if os.path.exists(cacheFile):
+        with open(cacheFile, "r") as f:
+            cached = json.load(f)
+        gridSizes = {d: da.sizes.get(d) for d in cached["sizes"].keys()}
+        if (cached["box"] == thisBox) and (cached["sizes"] == gridSizes):
+            return cached["windows"]
+
+    # Select the cells in the box
+    inBox = cutoutMask(config, da, gridID).compute()
+    if not inBox.any():
+        sys.exit(f"No grid cells from '{gridID}' found inside the cutout box.")
+
+    # Convert to a window of indices along each dimension. Along a 1-D longitude
+    # axis, the largest gap between the selected cells, allowing for wrapping
+    # around the end of the axis, is left out of the window
+    lonName = lonLatCoords(da, gridID)[0]
+    windows = {}
+    for thisDim in inBox.dims:
+        otherDims = [d for d in inBox.dims if d != thisDim]
+        theseIdxs = np.nonzero(inBox.any(otherDims).values)[0]
+        windows[thisDim] = [int(theseIdxs.min()), int(theseIdxs.max()) + 1]
+        if (da[lonName].dims == (thisDim,)) and (len(theseIdxs) > 1):
+            theseGaps = np.diff(theseIdxs)
+            wrapGap = theseIdxs[0] + inBox.sizes[thisDim] - theseIdxs[-1]
+            if theseGaps.max() > wrapGap:
+                i = int(np.argmax(theseGaps))
+                windows[thisDim] = [int(theseIdxs[i + 1]), int(theseIdxs[i]) + 1]
+
+    # Write to cache. We write to a temporary file first and then move it into
+    # place, to avoid problems with concurrent jobs
+    os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+    tmpFile = f"{cacheFile}.{os.getpid()}"
+    with open(tmpFile, "w") as f:
+        json.dump({"box": thisBox,
+                   "sizes": {d: da.sizes[d] for d in windows.keys()},
+                   "windows": windows}, f)
+    os.replace(tmpFile, cacheFile)
+
+    return windows
+
+
+def applyCutout(config, da, gridID):
+    """
+    Apply cutout
+
+    Cuts `da` down to the window covering the configured lonlatbox cutout (see
+    getCutoutWindow()). A window that wraps around the seam of the longitude axis
+    is read as two pieces and joined, and the longitudes are then made continuous
+    from the western boundary of the box, as with `sellonlatbox`. On curvilinear
+    grids, cells inside the window but outside the box are masked.
+    """
+    windows = getCutoutWindow(config, da, gridID)
+    wrapped = {d: w for d, w in windows.items() if w[0] >= w[1]}
+    da = da.isel({d: slice(*w) for d, w in windows.items() if d not in wrapped})
+    lonName, latName = lonLatCoords(da, gridID)
+    for thisDim, (start, stop) in wrapped.items():
+        da = xr.concat([da.isel({thisDim: slice(start, None)}),
+                        da.isel({thisDim: slice(0, stop)})],
+                       dim=thisDim, coords="minimal",
+                       compat="override", join="override")
+        xmin = config["cutouts"]["xmin"]
+        da = da.assign_coords({lonName: (da[lonName].dims,
+                                         xmin + (da[lonName].values - xmin) % 360,
+                                         da[lonName].attrs)})
+    if (da[lonName].ndim > 1) or (da[latName].ndim > 1):
+        da = da.where(cutoutMask(config, da, gridID))
+    return da
@@ -0,0 +1,77 @@
+"""
+#Setup for debugging with VS Code
+import os
+print(os.getcwd())
+os.chdir("..")
+import KAPy
+os.chdir("..")
+config=KAPy.getConfig("./config/config.yaml")
+wf=KAPy.getWorkflow(config)
+outFile=[next(iter(wf['references']))]
+inFiles=wf['references'][outFile[0]]
+"""
+
+# Builds virtual (kerchunk) reference indices over the raw input files
+import os
+import json
+import xarray as xr
+from . import inventory
+
+
+def buildReference(config, inFiles, outFile):
+    """
+    Build a virtual reference index
+
+    Scans the chunks in each of the input files and combines them into a single
+    kerchunk reference index, which maps the byte ranges of the original chunks. The
+    index can then be opened as a single dataset without copying any data and without
+    opening each of the input files in turn.
+    """
+    # Kerchunk is only required when virtual references are used
+    from kerchunk.combine import MultiZarrToZarr
+
+    # Put the files in time order, based on the input inventory
+    invTbl = inventory.getInventory(config, inFiles)
+    inFiles = list(invTbl.sort_values("tStartNum")["path"])
+
+    # Build references for the individual files
+    fileRefs = [scanFileReference(f) for f in inFiles]
+
+    # Combine along the time dimension. Variables that don't vary in time are taken
+    # from the first file, in the same way as join="override" in buildPrimVar
+    with xr.open_dataset(inFiles[0], decode_times=False, chunks={}) as ds:
+        staticVars = [v for v in ds.variables if "time" not in ds[v].dims]
+    combinedRefs = MultiZarrToZarr(fileRefs,
+                                   concat_dims=["time"],
+                                   identical_dims=staticVars,
+                                   coo_map={"time": "cf:time"}).translate()
+
+    # Write out
+    with open(outFile[0], "w") as f:
+        json.dump(combinedRefs, f)
+
+
+def scanFileReference(thisPath):
+    # Generate the references for a single file. NetCDF4 files are HDF5 files
+    # underneath, while NetCDF3 (classic) files require a different scanner. Absolute
+    # paths are used so that the references can be opened from anywhere
+    from kerchunk.hdf import SingleHdf5ToZarr
+    from kerchunk.netCDF3 import NetCDF3ToZarr
+    import fsspec
+
+    absPath = os.path.abspath(thisPath)
+    with open(absPath, "rb") as f:
+        magicBytes = f.read(3)
+    if magicBytes == b"CDF":
+        return NetCDF3ToZarr(absPath).translate()
+    with fsspec.open(absPath, "rb") as f:
+        return SingleHdf5ToZarr(f, absPath).translate()
+
+
+def referencedFiles(thisPath):
+    # List of the original files referred to by a reference index. Inline values are
+    # stored as strings, while references to chunks are given as [url, offset, length]
+    with open(thisPath, "r") as f:
+        theseRefs = json.load(f)["refs"]
+    theseURLs = {v[0] for v in theseRefs.values() if isinstance(v, list)}
+    return sorted([u.removeprefix("file://") for u in theseURLs])
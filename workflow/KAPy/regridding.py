@@ -14,41 +14,83 @@ outFile=["~/foo.nc"]
 
 from cdo import Cdo
 import xarray as xr
+import os
 import sys
+import json
+import hashlib
+import numpy as np
+import scipy.sparse
 from . import helpers
 
+# Dimensions along which fields are regridded independently, including the dimension
+# along which files are stacked for batched regridding
+sliceDims = ["time", "periodID", "season", "batch"]
 
-def regrid(config, inFile, outFile):
-    # Currently only works for 'cdo' regridding. Other engines such as xesmf could be supported in the future
-    if not config["outputGrid"]["regriddingEngine"] == "cdo":
-        sys.exit("Regridding options are currently limited to cdo. See documentation")
 
-    # Setup CDO object
-    cdo = Cdo()
+def regrid(config, inFile, outFile):
+    # Currently works with 'cdo' and 'native' regridding. Other engines such as xesmf could be supported in the future
+    if config["outputGrid"]["regriddingEngine"] not in ["cdo", "native"]:
+        sys.exit("Regridding options are currently limited to cdo and native. See documentation")
 
     # We want to handle regridding slightly differently between time binning
     # based on periods and based on years / months - this is because CDO
     # doesn't like the idea of a periodID dimension. Start by opening
     # the file with xarray to figure out what we've got
-    thisDat = helpers.readFile(inFile[0])
+    thisDat = helpers.setPrecision(config, helpers.readFile(inFile[0]))
+
+    # With time dimensions, CDO can work on the input file directly. The bin index
+    # can't be passed through CDO, and is removed on the way in
+    hasBinIndex = helpers.binIndexCoord in thisDat.coords
+    cdoInput = f"-delname,{helpers.binIndexCoord} {inFile[0]}" if hasBinIndex else inFile[0]
+    dout = regridData(config, thisDat, cdoInput, inFile[0])
+
+    # Write out in the working precision, applying the output encoding
+    dout = helpers.setPrecision(config, dout)
+    helpers.writeNetCDF(config, dout, outFile[0], "regridded")
+
+
+def regridData(config, thisDat, cdoInput, label):
+    """
+    Regrid data
+
+    Regrids a DataArray or Dataset onto the output grid with the configured engine,
+    returning the result. `cdoInput` is an input for CDO that is equivalent to
+    `thisDat` with the bin index removed (a path or CDO operator chain), used for data
+    with time dimensions. `label` identifies the data in error messages.
+    """
+    # The native engine handles all structures in one hit, as a single sparse
+    # matrix product over all of the time steps or periods
+    if config["outputGrid"]["regriddingEngine"] == "native":
+        return nativeRegrid(config, thisDat)
+
+    # Setup CDO object
+    cdo = Cdo()
 
     # If we have time dimensions, then we can just do the regridding in one hit
     if "time" in thisDat.dims:
-        # Apply regridding
-        cdo.remapbil(
-            config["outputGrid"]["cdoGriddes"], input=inFile[0], output=outFile[0]
+        # The bin index is restored, together with the time axis, directly from the
+        # input, rather than being decoded again from the CDO output
+        hasBinIndex = helpers.binIndexCoord in thisDat.coords
+        # Apply regridding, using the cached weights for this grid
+        weights = regridWeights(config, cdo, cdoInput, thisDat)
+        dout = cdo.remap(
+            f"{config['outputGrid']['cdoGriddes']},{weights}", input=cdoInput, returnXDataset=True
         )
+        if hasBinIndex:
+            dout = dout.assign_coords(time=thisDat.time,
+                                      **{helpers.binIndexCoord: thisDat[helpers.binIndexCoord]})
 
     # Otherwise if we have periodIDs dimensions, then we need to loop over the
     # periods manually
     elif "periodID" in thisDat.dims:
+        weights = regridWeights(config, cdo, thisDat.isel(periodID=0), thisDat)
         periodSlices = []
         for thisPeriodID in thisDat.periodID.values:
             # Extract period slide
             thisPeriodDat = thisDat.sel(periodID=thisPeriodID)
             # Apply regridding back to an xarray
-            regridded = cdo.remapbil(
-                config["outputGrid"]["cdoGriddes"],
+            regridded = cdo.remap(
+                f"{config['outputGrid']['cdoGriddes']},{weights}",
                 input=thisPeriodDat,
                 returnXDataset=True,
             )
@@ -58,9 +100,321 @@ def regrid(config, inFile, outFile):
         dout = xr.concat(periodSlices, dim="periodID")
         dout["periodID"] = thisDat.periodID
 
-        # Finally, we need to write out manually
-        dout.to_netcdf(outFile[0])
-
     # Otherwise, shouldn't be here
     else:
-        sys.exit(f"Can't identify structure of input file : {inFile[0]}.")
+        sys.exit(f"Can't identify structure of input file : {label}.")
+
+    return dout
+
+
+def regridBatch(config, inFiles, outFiles):
+    """
+    Regrid a batch of files
+
+    Regrids the indicator files `inFiles` of a single member onto the output grid,
+    writing each to the corresponding file in `outFiles`. Files that share a
+    structure (the same grid and the same time steps or periods) are stacked into a
+    single dataset, regridded in one operation and then split again, so that the
+    overhead of each regridding call (reading the grid, loading the weights or
+    launching CDO) is paid once for each structure rather than once for each file.
+    """
+    if config["outputGrid"]["regriddingEngine"] not in ["cdo", "native"]:
+        sys.exit("Regridding options are currently limited to cdo and native. See documentation")
+    theseDats = [helpers.setPrecision(config, helpers.readFile(f)) for f in inFiles]
+
+    # Group by structure
+    groups = {}
+    for i, thisDat in enumerate(theseDats):
+        sliceValues = [str(thisDat[d].values.tolist()) for d in thisDat.dims if d in sliceDims]
+        groups.setdefault((gridHash(thisDat), thisDat.dims, *sliceValues), []).append(i)
+
+    # Regrid each group in one hit, and split into the individual outputs again
+    for theseIdxs in groups.values():
+        stacked = xr.merge([theseDats[i].rename(f"batch{i}") for i in theseIdxs],
+                           join="exact", compat="override", combine_attrs="drop")
+        if config["outputGrid"]["regriddingEngine"] == "native":
+            # A single product over all of the files
+            regridded = nativeRegrid(config, stacked.to_dataarray(dim="batch")).to_dataset(dim="batch")
+        else:
+            cdoInput = stacked.drop_vars(helpers.binIndexCoord, errors="ignore")
+            regridded = regridData(config, stacked, cdoInput, ", ".join(inFiles))
+        for i in theseIdxs:
+            dout = regridded[f"batch{i}"].rename(theseDats[i].name)
+            dout.attrs = theseDats[i].attrs
+            # Attributes of the time and period coordinates are lost in stacking
+            for thisCoord in dout.coords:
+                if (thisCoord in theseDats[i].coords) and set(dout[thisCoord].dims) <= set(sliceDims):
+                    dout[thisCoord].attrs = theseDats[i][thisCoord].attrs
+            dout = helpers.setPrecision(config, dout)
+            helpers.writeNetCDF(config, dout, outFiles[i], "regridded")
+
+
+def gridHash(thisDat):
+    # Hash of the horizontal grid of a dataset, built from the names, dimensions,
+    # attributes and values of the coordinates that describe it i.e. those that don't
+    # vary in time, between periods or between seasons
+    thisHash = hashlib.sha1()
+    for thisCoord in sorted(thisDat.coords):
+        theseDims = thisDat[thisCoord].dims
+        if (len(theseDims) == 0) or any([d in sliceDims for d in theseDims]):
+            continue
+        thisHash.update(f"|{thisCoord}|{theseDims}|".encode())
+        thisHash.update(json.dumps(thisDat[thisCoord].attrs, sort_keys=True, default=str).encode())
+        thisHash.update(thisDat[thisCoord].values.astype(str).tobytes()
+                        if thisDat[thisCoord].dtype.kind == "O"
+                        else thisDat[thisCoord].values.tobytes())
+    return thisHash.hexdigest()
+
+
+def targetGridHash(config):
+    # Hash of the target grid. The grid descriptor is either a file, in which case
+    # its contents are used, or the name of one of the predefined CDO grids
+    thisGriddes = config["outputGrid"]["cdoGriddes"]
+    if os.path.isfile(thisGriddes):
+        with open(thisGriddes, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    return hashlib.sha1(thisGriddes.encode()).hexdigest()
+
+
+def weightsPath(config, thisDat, engine="cdo"):
+    # Path of the cached interpolation weights from the grid of `thisDat` to the
+    # output grid, keyed by the hashes of the two grids. Weights calculated by the
+    # native engine lack the grid information that CDO needs, and are kept apart
+    prefix = "bil" if engine == "cdo" else f"bil-{engine}"
+    return os.path.join(config["dirs"]["cache"], "regridding",
+                        f"{prefix}_{gridHash(thisDat)}_{targetGridHash(config)}.nc")
+
+
+def regridWeights(config, cdo, cdoInput, thisDat):
+    """
+    Get regridding weights
+
+    Returns the path to a file of bilinear interpolation weights from the grid of
+    `thisDat` to the output grid. Weights are generated once for each pair of source
+    and target grids, using `cdo genbil`, and are then stored in the cache directory,
+    keyed by the hashes of the two grids, for reuse by all subsequent regridding
+    jobs. `cdoInput` is the CDO input from which the weights are generated.
+    """
+    weightsFile = weightsPath(config, thisDat)
+    if not os.path.exists(weightsFile):
+        # Write to a temporary file first and then move it into place, as other
+        # jobs may be generating the same weights at the same time
+        os.makedirs(os.path.dirname(weightsFile), exist_ok=True)
+        tmpFile = f"{weightsFile}.{os.getpid()}"
+        cdo.genbil(config["outputGrid"]["cdoGriddes"], input=cdoInput, output=tmpFile)
+        os.replace(tmpFile, weightsFile)
+    return weightsFile
+
+
+def parseGriddes(thisGriddes):
+    # Latitudes and longitudes of a regular lon-lat grid described by a CDO grid
+    # descriptor file. Returns None for other types of grid, and for the predefined
+    # CDO grids. Values can run over several lines
+    if not os.path.isfile(thisGriddes):
+        return None
+    entries = {}
+    with open(thisGriddes, "r") as f:
+        for thisLine in f:
+            thisLine = thisLine.split("#")[0].strip()
+            if "=" in thisLine:
+                thisKey, thisVal = [x.strip() for x in thisLine.split("=", 1)]
+                entries[thisKey] = thisVal
+            elif thisLine != "":
+                entries[thisKey] += " " + thisLine
+    if entries.get("gridtype") not in ["lonlat", "latlon"]:
+        return None
+    axes = {}
+    for thisAxis in ["x", "y"]:
+        if f"{thisAxis}vals" in entries:
+            axes[thisAxis] = np.array([float(v) for v in entries[f"{thisAxis}vals"].split()])
+        else:
+            axes[thisAxis] = float(entries[f"{thisAxis}first"]) + \
+                float(entries[f"{thisAxis}inc"]) * np.arange(int(entries[f"{thisAxis}size"]))
+    return axes["y"], axes["x"]
+
+
+def rectilinearCoords(thisDat, spatialDims):
+    # Latitude and longitude dimensions of a dataset on a rectilinear grid, or None if
+    # the grid is not rectilinear. Coordinates are identified by their name, standard
+    # name or units
+    theseAxes = {}
+    for thisDim in spatialDims:
+        if thisDim not in thisDat.coords:
+            return None
+        theseAttrs = thisDat[thisDim].attrs
+        if (thisDim in ["lat", "latitude"]) or (theseAttrs.get("standard_name") == "latitude") \
+                or (theseAttrs.get("units") == "degrees_north"):
+            theseAxes["lat"] = thisDim
+        elif (thisDim in ["lon", "longitude"]) or (theseAttrs.get("standard_name") == "longitude") \
+                or (theseAttrs.get("units") == "degrees_east"):
+            theseAxes["lon"] = thisDim
+    if len(theseAxes) != 2:
+        return None
+    return theseAxes["lat"], theseAxes["lon"]
+
+
+def axisWeights(src, dst):
+    # Indices of the lower and upper neighbours of each target point along a single
+    # axis, and the weight of the upper neighbour. Target points outside the range of
+    # the source axis are flagged as invalid
+    flip = src[0] > src[-1]
+    srcAsc = src[::-1] if flip else src
+    idx = np.clip(np.searchsorted(srcAsc, dst, side="right") - 1, 0, len(src) - 2)
+    wHi = (dst - srcAsc[idx]) / (srcAsc[idx + 1] - srcAsc[idx])
+    valid = (dst >= srcAsc[0]) & (dst <= srcAsc[-1])
+    if flip:
+        return len(src) - 1 - idx, len(src) - 2 - idx, wHi, valid
+    return idx, idx + 1, wHi, valid
+
+
+def bilinearWeights(srcLat, srcLon, dstLat, dstLon):
+    """
+    Bilinear interpolation weights
+
+    Returns a sparse matrix of bilinear interpolation weights between two rectilinear
+    grids, mapping the flattened (lat, lon) source grid onto the flattened target
+    grid. Target points outside of the source grid get no weights, and are missing
+    in the output, as are those next to missing source values.
+    """
+    # Periodic source grids, where the first longitude follows on from the last, are
+    # wrapped by repeating the first column 360 degrees on, so that target points
+    # across the seam are interpolated as well
+    nLon = len(srcLon)
+    lonStep = np.median(np.abs(np.diff(srcLon))) if nLon > 1 else 360
+    lonGap = 360 - (srcLon.max() - srcLon.min())
+    if 0 < lonGap <= 1.5 * lonStep:
+        srcLon = np.append(srcLon, srcLon[0] + (360 if srcLon[-1] > srcLon[0] else -360))
+    # Bring the target longitudes into the range of the source longitudes
+    dstLon = np.where(dstLon < srcLon.min(), dstLon + 360, dstLon)
+    dstLon = np.where(dstLon > srcLon.max(), dstLon - 360, dstLon)
+    latLo, latHi, wLat, latValid = axisWeights(srcLat, dstLat)
+    lonLo, lonHi, wLon, lonValid = axisWeights(srcLon, dstLon)
+    lonLo, lonHi = lonLo % nLon, lonHi % nLon
+    # Weights of the four corners of each target cell, as (target, source, weight)
+    dstIdx = np.arange(len(dstLat) * len(dstLon)).reshape(len(dstLat), len(dstLon))
+    valid = latValid[:, None] & lonValid[None, :]
+    rows, cols, vals = [], [], []
+    for thisLat, thisWLat in [(latLo, 1 - wLat), (latHi, wLat)]:
+        for thisLon, thisWLon in [(lonLo, 1 - wLon), (lonHi, wLon)]:
+            rows += [dstIdx[valid]]
+            cols += [(thisLat[:, None] * nLon + thisLon[None, :])[valid]]
+            vals += [(thisWLat[:, None] * thisWLon[None, :])[valid]]
+    W = scipy.sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(dstIdx.size, len(srcLat) * nLon))
+    # Drop zero weights, so that missing values at those points don't propagate
+    W.eliminate_zeros()
+    return W
+
+
+def writeWeights(W, srcShape, dstLat, dstLon, thisPath):
+    # Store weights in the SCRIP format used by CDO, with 1-based addresses
+    coo = W.tocoo()
+    dstLon2D, dstLat2D = np.meshgrid(dstLon, dstLat)
+    ds = xr.Dataset({"src_grid_dims": ("src_grid_rank", np.array(srcShape[::-1], dtype=np.int32)),
+                     "dst_grid_dims": ("dst_grid_rank", np.array([len(dstLon), len(dstLat)], dtype=np.int32)),
+                     "dst_grid_center_lat": ("dst_grid_size", dstLat2D.ravel(), {"units": "degrees"}),
+                     "dst_grid_center_lon": ("dst_grid_size", dstLon2D.ravel(), {"units": "degrees"}),
+                     "src_address": ("num_links", (coo.col + 1).astype(np.int32)),
+                     "dst_address": ("num_links", (coo.row + 1).astype(np.int32)),
+                     "remap_matrix": (("num_links", "num_wgts"), coo.data[:, None])},
+                    attrs={"map_method": "Bilinear remapping"})
+    os.makedirs(os.path.dirname(thisPath), exist_ok=True)
+    tmpFile = f"{thisPath}.{os.getpid()}"
+    ds.to_netcdf(tmpFile)
+    os.replace(tmpFile, thisPath)
+
+
+def readWeights(thisPath):
+    # Read weights in the SCRIP format, as written by CDO or by writeWeights(). Returns
+    # the sparse weight matrix and the latitudes and longitudes of the target grid.
+    # These are 1-D axes when the target grid is rectilinear, and 2-D (y, x) arrays
+    # otherwise e.g. for rotated or curvilinear grids
+    with xr.open_dataset(thisPath, decode_times=False) as ds:
+        nSrc = int(np.prod(ds["src_grid_dims"].values))
+        nLon, nLat = [int(n) for n in ds["dst_grid_dims"].values]
+        W = scipy.sparse.csr_matrix((ds["remap_matrix"].values[:, 0],
+                                     (ds["dst_address"].values - 1, ds["src_address"].values - 1)),
+                                    shape=(nLon * nLat, nSrc))
+        dstLat = ds["dst_grid_center_lat"].values.reshape(nLat, nLon)
+        dstLon = ds["dst_grid_center_lon"].values.reshape(nLat, nLon)
+        if ds["dst_grid_center_lat"].attrs.get("units", "degrees").startswith("radian"):
+            dstLat, dstLon = np.rad2deg(dstLat), np.rad2deg(dstLon)
+    if np.allclose(dstLat, dstLat[:, :1]) and np.allclose(dstLon, dstLon[:1, :]):
+        dstLat, dstLon = dstLat[:, 0], dstLon[0, :]
+    return W, dstLat, dstLon
+
+
+def sparseProduct(W, x):
+    # Apply a sparse weight matrix over the last two (spatial) dimensions of an array,
+    # for all of the leading dimensions in a single product. Target points without
+    # any weights are missing
+    flatX = x.reshape(-1, W.shape[1])
+    outType = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+    rtn = (W @ flatX.T).T.astype(outType, copy=False)
+    rtn[:, np.diff(W.indptr) == 0] = np.nan
+    return rtn
+
+
+def nativeRegrid(config, thisDat):
+    """
+    Regrid in-process
+
+    Regrids all of the time steps or periods of `thisDat` to the output grid as a
+    single sparse matrix product, without temporary files or subprocesses. The
+    bilinear weights are taken from the cache directory where available, whether
+    generated by CDO or here. Otherwise, they are calculated directly when both the
+    source grid and the output grid (a `lonlat` grid descriptor) are rectilinear,
+    and generated once with `cdo genbil` when they are not. Weights calculated here
+    are cached separately, as they can't be used by CDO. As with the `cdo`
+    engine, output grids that are not rectilinear are returned on (y, x) dimensions
+    with 2-D latitude and longitude coordinates.
+    """
+    spatialDims = [d for d in thisDat.dims if d not in sliceDims]
+    if len(spatialDims) != 2:
+        sys.exit(f"Can't identify the horizontal dimensions of '{thisDat.name}': {thisDat.dims}.")
+    srcAxes = rectilinearCoords(thisDat, spatialDims)
+    if srcAxes is not None:
+        spatialDims = list(srcAxes)
+
+    # Get weights, preferring those generated by CDO
+    weightsFile = weightsPath(config, thisDat)
+    if not os.path.exists(weightsFile):
+        dstAxes = parseGriddes(config["outputGrid"]["cdoGriddes"])
+        if (srcAxes is not None) and (dstAxes is not None):
+            weightsFile = weightsPath(config, thisDat, engine="native")
+            if not os.path.exists(weightsFile):
+                srcLat, srcLon = thisDat[srcAxes[0]].values, thisDat[srcAxes[1]].values
+                writeWeights(bilinearWeights(srcLat, srcLon, *dstAxes),
+                             (len(srcLat), len(srcLon)), *dstAxes, weightsFile)
+        else:
+            thisSlice = thisDat.isel({d: 0 for d in thisDat.dims if d not in spatialDims})
+            regridWeights(config, Cdo(), thisSlice, thisDat)
+    W, dstLat, dstLon = readWeights(weightsFile)
+    if dstLat.ndim == 1:
+        dstDims, dstShape = ["lat", "lon"], (len(dstLat), len(dstLon))
+    else:
+        dstDims, dstShape = ["y", "x"], dstLat.shape
+
+    # Apply as a single product over all slices. The horizontal dimensions need to be
+    # in a single chunk, while the slices can be spread over several
+    if thisDat.chunks is not None:
+        thisDat = thisDat.chunk({d: -1 for d in spatialDims})
+    outType = thisDat.dtype if np.issubdtype(thisDat.dtype, np.floating) else np.float64
+    dout = xr.apply_ufunc(lambda x: sparseProduct(W, x).reshape(x.shape[:-2] + dstShape),
+                          thisDat,
+                          input_core_dims=[spatialDims],
+                          output_core_dims=[dstDims],
+                          exclude_dims=set(spatialDims),
+                          dask="parallelized",
+                          output_dtypes=[outType],
+                          dask_gufunc_kwargs={"output_sizes": dict(zip(dstDims, dstShape))},
+                          keep_attrs=True)
+    # Coordinates of the source grid are replaced by those of the output grid
+    dout = dout.drop_vars([c for c in dout.coords
+                           if any([d in spatialDims + dstDims for d in dout[c].dims])]
+                          + [c for c in ["lat", "lon"] if c in dout.coords])
+    latDims, lonDims = (["lat"], ["lon"]) if dstLat.ndim == 1 else (dstDims, dstDims)
+    dout = dout.assign_coords(lat=(latDims, dstLat, {"standard_name": "latitude", "units": "degrees_north"}),
+                              lon=(lonDims, dstLon, {"standard_name": "longitude", "units": "degrees_east"}))
+    dout.attrs.pop("grid_mapping", None)
+    return dout
@@ -0,0 +1,224 @@
+"""
+#Setup for debugging with VS Code
+import os
+print(os.getcwd())
+os.chdir("..")
+import KAPy
+os.chdir("..")
+config=KAPy.getConfig("./config/config.yaml")
+wf=KAPy.getWorkflow(config)
+"""
+
+# Estimates the memory and runtime required by each job, from header information only
+import os
+import math
+import pandas as pd
+from . import inventory
+from . import helpers
+
+# Default coefficients relating the size of the data that a job works on (in MB) to
+# the memory (in MB) and runtime (in seconds) that it requires, by stage. These are
+# deliberately generous, and are refined from the measured runs in the calibration
+# table stored in the cache directory
+defaultCalibration = pd.DataFrame(
+    [{"stage": "references", "memBase": 500.0, "memFactor": 0.0, "runtimeBase": 60.0, "runtimeRate": 0.01},
+     {"stage": "variables", "memBase": 500.0, "memFactor": 3.0, "runtimeBase": 60.0, "runtimeRate": 0.05},
+     {"stage": "calibration", "memBase": 1000.0, "memFactor": 8.0, "runtimeBase": 120.0, "runtimeRate": 0.2},
+     {"stage": "monthlyCube", "memBase": 500.0, "memFactor": 2.0, "runtimeBase": 60.0, "runtimeRate": 0.05},
+     {"stage": "indicators", "memBase": 500.0, "memFactor": 3.0, "runtimeBase": 60.0, "runtimeRate": 0.05},
+     {"stage": "regridded", "memBase": 500.0, "memFactor": 3.0, "runtimeBase": 60.0, "runtimeRate": 0.05},
+     {"stage": "ensembleCubes", "memBase": 500.0, "memFactor": 3.0, "runtimeBase": 60.0, "runtimeRate": 0.05},
+     {"stage": "ensstats", "memBase": 500.0, "memFactor": 4.0, "runtimeBase": 60.0, "runtimeRate": 0.05},
+     {"stage": "arealstats", "memBase": 500.0, "memFactor": 2.0, "runtimeBase": 60.0, "runtimeRate": 0.05}]
+).set_index("stage").astype(float)
+
+
+def stageDir(config, stage):
+    # Directory in which the outputs of a stage are written
+    if stage == "references":
+        return os.path.join(config["dirs"]["cache"], "references")
+    elif stage == "monthlyCube":
+        return os.path.join(config["dirs"]["cache"], "monthly")
+    elif stage == "ensembleCubes":
+        return os.path.join(config["dirs"]["cache"], "ensembleCubes")
+    return config["dirs"][stage]
+
+
+def benchmarkPath(config, stage, outPath):
+    # Path of the snakemake benchmark file of the job writing `outPath`. Benchmark files
+    # mirror the layout of the outputs of each stage, so that this also works on the
+    # patterns used to define the rules
+    return os.path.join(config["dirs"]["cache"], "benchmarks", stage,
+                        os.path.relpath(outPath, stageDir(config, stage)) + ".tsv")
+
+
+def dataSizeMB(thisShape):
+    # In-memory size of the data described by a shape record
+    return thisShape["cells"] * thisShape["nSteps"] * thisShape["itemSize"] / 1024**2
+
+
+def primaryVariableShapes(config, wf):
+    # Shape records for each primary variable, built from the inventory of the input
+    # files: the number of grid cells, the number of time steps, the number of years
+    # covered and the size of each value in the working precision
+    pvShapes = {}
+    for inpID, theseFiles in wf["primVars"].items():
+        rawFiles = {pvPath: [f for inFile in inFiles
+                             for f in wf["references"].get(inFile, [inFile])]
+                    for pvPath, inFiles in theseFiles.items()}
+        invTbl = inventory.getInventory(config, list(dict.fromkeys(f for v in rawFiles.values() for f in v)))
+        for pvPath, inFiles in rawFiles.items():
+            thisTbl = invTbl.loc[inFiles]
+            itemSize = int(thisTbl["itemSize"].max())
+            if config["processing"]["precision"] == "float32":
+                itemSize = min(itemSize, 4)
+            pvShapes[pvPath] = {
+                "cells": math.prod([int(x.split("=")[1]) for x in thisTbl["gridShape"].iloc[0].split(",")]),
+                "nSteps": int(thisTbl["nTime"].sum()),
+                "nYears": max((thisTbl["tEndNum"].max() - thisTbl["tStartNum"].min()) / 365.25, 1),
+                "itemSize": itemSize}
+    return pvShapes
+
+
+def jobSizes(config, wf):
+    """
+    Size the jobs in the workflow
+
+    Returns a dict giving the stage and the size of the data worked on (in MB) for
+    the job writing each output in the workflow `wf`. Sizes are derived from the
+    input inventory and propagated through the stages, so that no intermediate files
+    need to exist.
+    """
+    shapes = primaryVariableShapes(config, wf)
+    jobs = {}
+    # Primary variables and their reference indices
+    for theseFiles in wf["primVars"].values():
+        for pvPath, inFiles in theseFiles.items():
+            jobs[pvPath] = ("variables", dataSizeMB(shapes[pvPath]))
+            for inFile in inFiles:
+                if inFile in wf["references"]:
+                    jobs[inFile] = ("references", dataSizeMB(shapes[pvPath]))
+    # Calibrated variables are on the grid of the reference
+    for outPath, theseInps in wf["calibratedVars"].items():
+        histSim, ref = shapes[theseInps["histSim"]], shapes[theseInps["ref"]]
+        shapes[outPath] = {**histSim, "cells": ref["cells"]}
+        jobs[outPath] = ("calibration", dataSizeMB(histSim) + dataSizeMB(ref))
+    for outPath, inFiles in wf["monthlyCubes"].items():
+        jobs[outPath] = ("monthlyCube", dataSizeMB(shapes[inFiles[0]]))
+    # Indicators have one time step per bin and season
+    for indID, theseFiles in wf["indicators"].items():
+        thisInd = config["indicators"][indID]
+        for outPath, inFiles in theseFiles.items():
+            varShape = shapes[inFiles[0]]
+            if thisInd["time_binning"] == "periods":
+                nBins = len(config["periods"])
+            elif thisInd["time_binning"] == "years":
+                nBins = math.ceil(varShape["nYears"])
+            else:
+                nBins = 12 * math.ceil(varShape["nYears"])
+            shapes[outPath] = {**varShape,
+                               "nSteps": nBins * len(helpers.indicatorSeasons(config, thisInd))}
+            jobs[outPath] = ("indicators", dataSizeMB(varShape))
+    for outPath, inFiles in wf["regridded"].items():
+        shapes[outPath] = shapes[inFiles[0]]
+        jobs[outPath] = ("regridded", dataSizeMB(shapes[inFiles[0]]))
+    # Ensemble cubes are written one member at a time. Reading a cube gives the data
+    # of a single member, as for the member files
+    for outPath, inFiles in wf["ensembleCubes"].items():
+        shapes[outPath] = shapes[inFiles[0]]
+        jobs[outPath] = ("ensembleCubes", max([dataSizeMB(shapes[f]) for f in inFiles]))
+    # Ensemble statistics hold the mean, standard deviation, maximum, minimum and the
+    # percentiles of all of the members. When streamed, only one tile of each member
+    # is held at a time by each thread
+    tileSize = config["processing"]["ensembleTileSize"]
+    for outPath, inFiles in wf["ensstats"].items():
+        inFiles = wf["ensembleCubes"].get(inFiles[0], inFiles)
+        nStats = 4 + len(config["ensembles"])
+        shapes[outPath] = {**shapes[inFiles[0]], "nSteps": nStats * shapes[inFiles[0]]["nSteps"]}
+        sizeMB = sum([dataSizeMB(shapes[f]) for f in inFiles])
+        if tileSize > 0:
+            tileShape = {**shapes[inFiles[0]], "cells": tileSize * helpers.stageResources(config, "ensstats")["threads"]}
+            sizeMB = min(sizeMB, len(inFiles) * dataSizeMB(tileShape))
+        jobs[outPath] = ("ensstats", sizeMB)
+    for outPath, inFiles in wf["arealstats"].items():
+        jobs[outPath] = ("arealstats", dataSizeMB(shapes[inFiles[0]]))
+    return jobs
+
+
+def readBenchmark(thisPath):
+    # Peak memory (MB) and runtime (s) recorded in a snakemake benchmark file. If the
+    # job was repeated, the largest values are used
+    thisTbl = pd.read_csv(thisPath, sep="\t", na_values=["NA", "-"])
+    return thisTbl["max_rss"].max(), thisTbl["s"].max()
+
+
+def fitCoefficients(sizes, measured, base, factor):
+    # Refit the coefficients of a line so that it covers all of the measurements. The
+    # slope is only refitted from jobs that are large enough for the data to dominate,
+    # as small jobs say little about it. The intercept is then lowered (or raised) to
+    # just cover the measurements
+    largeJobs = [(s, m) for s, m in zip(sizes, measured) if s * factor >= base]
+    if len(largeJobs) > 0:
+        factor = max(max([(m - base) / s for s, m in largeJobs]), 0)
+    base = max([m - factor * s for s, m in zip(sizes, measured)])
+    return max(base, 1), factor
+
+
+def getCalibration(config, jobs):
+    """
+    Get the resource calibration table
+
+    Returns the coefficients used to estimate the resources of each stage. The
+    coefficients are fitted to the snakemake benchmark files of previous runs, where
+    available, and the default coefficients are used otherwise. The fitted table is
+    stored in the cache directory, and is only refitted when new benchmarks appear.
+    """
+    calFile = os.path.join(config["dirs"]["cache"], "resources.tsv")
+    calTime = os.path.getmtime(calFile) if os.path.exists(calFile) else -1
+    theseBenchmarks = {outPath: benchmarkPath(config, stage, outPath) for outPath, (stage, sizeMB) in jobs.items()}
+    theseBenchmarks = {k: v for k, v in theseBenchmarks.items() if os.path.exists(v)}
+    if (calTime >= 0) and all([os.path.getmtime(v) <= calTime for v in theseBenchmarks.values()]):
+        calTbl = pd.read_csv(calFile, sep="\t", index_col="stage").astype(float)
+        # Tables written by earlier versions may lack some of the stages, and are refitted
+        if set(defaultCalibration.index).issubset(calTbl.index):
+            return calTbl
+
+    # Refit from the benchmarks
+    calTbl = defaultCalibration.copy()
+    measTbl = pd.DataFrame([(jobs[k][0], jobs[k][1], *readBenchmark(v)) for k, v in theseBenchmarks.items()],
+                           columns=["stage", "sizeMB", "max_rss", "s"]).dropna()
+    for stage, thisTbl in measTbl.groupby("stage"):
+        calTbl.loc[stage, ["memBase", "memFactor"]] = \
+            fitCoefficients(thisTbl["sizeMB"], thisTbl["max_rss"], *calTbl.loc[stage, ["memBase", "memFactor"]])
+        calTbl.loc[stage, ["runtimeBase", "runtimeRate"]] = \
+            fitCoefficients(thisTbl["sizeMB"], thisTbl["s"], *calTbl.loc[stage, ["runtimeBase", "runtimeRate"]])
+
+    # Write to a temporary file first and then move it into place, to avoid problems
+    # with concurrent runs
+    os.makedirs(os.path.dirname(calFile), exist_ok=True)
+    tmpFile = f"{calFile}.{os.getpid()}"
+    calTbl.to_csv(tmpFile, sep="\t")
+    os.replace(tmpFile, calFile)
+    return calTbl
+
+
+def estimateResources(config, wf):
+    """
+    Estimate job resources
+
+    Returns a dict giving the estimated memory (`mem_mb`) and runtime (`runtime`, in
+    minutes) of the job writing each output in the workflow `wf`. The estimates are
+    linear in the size of the data that each job works on, using the coefficients in
+    the calibration table, and are inflated by `processing.resourceSafetyFactor`.
+    """
+    jobs = jobSizes(config, wf)
+    calTbl = getCalibration(config, jobs)
+    safety = config["processing"]["resourceSafetyFactor"]
+    rtn = {}
+    for outPath, (stage, sizeMB) in jobs.items():
+        theseCoefs = calTbl.loc[stage]
+        memMB = theseCoefs["memBase"] + theseCoefs["memFactor"] * sizeMB
+        runtime = theseCoefs["runtimeBase"] + theseCoefs["runtimeRate"] * sizeMB
+        rtn[outPath] = {"mem_mb": math.ceil(safety * memMB),
+                        "runtime": math.ceil(safety * runtime / 60)}
+    return rtn
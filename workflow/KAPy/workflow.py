@@ -15,6 +15,9 @@ import sys
 import os
 import pandas as pd
 import glob
+from . import inventory
+from . import indicators
+from . import resources
 
 def getWorkflow(config):
     """
@@ -29,10 +32,12 @@ def getWorkflow(config):
 
     # Primary Variables ---------------------------------------------------------------
     # PVs are the raw inputs. These need to be read into a single-file format based on
-    # xarray, and are then exported either as netcdf or as pickles.
+    # xarray, and are then exported either as netcdf, as pickles or as zarr stores.
     # We loop over the individual items maintaining the dict format, as this is a touch easier to
     # work with
     pvDict = {}
+    refDict = {}
+    pvExtensions = {"pickle": ".pkl", "netcdf": "", "zarr": ".zarr"}
     for thisKey, thisInp in inp.items():
         # Get file list
         inpTbl = pd.DataFrame(glob.glob(thisInp["path"]), columns=["inPath"])
@@ -128,14 +133,37 @@ def getWorkflow(config):
             for f in pvTbl["pvFname"]
         ]
 
-        # If we're pickling, name the output files accordingly
-        if config['processing']['picklePrimaryVariables']:
-            pvTbl["pvPath"] = pvTbl["pvPath"] + ".pkl"
+        # Use the input inventory to put the files making up each primary variable
+        # in time order, and check the time coverage before any jobs start
+        invTbl = inventory.getInventory(config, list(pvTbl["inPath"].unique()))
+        pvTbl["tStartNum"] = invTbl.loc[pvTbl["inPath"], "tStartNum"].values
+        pvTbl = pvTbl.sort_values(["pvPath", "tStartNum"])
+        for thisPV, thisTbl in pvTbl.groupby("pvPath"):
+            inventory.checkInventory(invTbl.loc[thisTbl["inPath"]], thisPV)
+
+        # If we're pickling or using zarr, name the output files accordingly
+        pvTbl["pvPath"] = pvTbl["pvPath"] + \
+            pvExtensions[config['processing']['primaryVariableFormat']]
         
         #Prior to adding to the pvDict, check that we have unique keys
         if any(pvTbl['pvPath'].isin(pvDict.keys())):
             sys.exit("Duplicate keys found in generating primary variables.")
 
+        # If we are using virtual references, a reference index is first built over
+        # the input files, and the primary variable is then built from the index
+        if config['processing']['virtualReferences']:
+            pvTbl["refPath"] = [
+                os.path.join(outDirs["cache"], "references", thisInp["varID"], f + ".json")
+                for f in pvTbl["pvFname"]
+            ]
+            refDict.update(
+                pvTbl.groupby("refPath")
+                .apply(lambda x: list(x["inPath"]), include_groups=False)
+                .to_dict()
+            )
+            pvTbl = pvTbl.drop_duplicates("pvPath")
+            pvTbl["inPath"] = pvTbl["refPath"]
+
         #Finally, make the dict
         pvDict[thisKey] =(
             pvTbl.groupby("pvPath")
@@ -153,7 +181,7 @@ def getWorkflow(config):
         thisTbl["srcID"] = thisTbl["fname"].str.extract("^[^_]+_([^_]+)_.*$")
         thisTbl["gridID"] = thisTbl["fname"].str.extract("^[^_]+_[^_]+_([^_]+)_.*$")
         thisTbl["expt"] = thisTbl["fname"].str.extract("^[^_]+_[^_]+_[^_]+_([^_]+)_.*$")
-        thisTbl["stems"] = thisTbl["fname"].str.extract("^[^_]+_[^_]+_[^_]+_[^_]+_(.+).nc(?:.pkl)$")
+        thisTbl["stems"] = thisTbl["fname"].str.extract(r"^[^_]+_[^_]+_[^_]+_[^_]+_(.+)\.nc(?:\.pkl|\.zarr)?$")
         return thisTbl
 
     varPal = parseFilelist([k for v in pvDict.values() for k in v.keys()])
@@ -241,10 +269,19 @@ def getWorkflow(config):
     # Indicators -----------------------------------------------------
     # Loop over indicators and get required files
     # Currently only matching one variable. TODO: Allow multiple variables
+    # If monthly cubes are in use, indicators that can be derived from monthly
+    # aggregates also depend on the monthly cube of their input variable, which is
+    # stored in the cache directory
     indDict = {}
+    cubeDict = {}
+    varPal["cubeFname"] = varPal["fname"].str.replace(r"(\.pkl|\.zarr)$", "", regex=True)
+    varPal["cubePath"] = [
+        os.path.join(outDirs["cache"], "monthly", rw["varID"], rw["cubeFname"])
+        for idx, rw in varPal.iterrows()
+    ]
     for indKey, thisInd in ind.items():
         #Build up the output filename first
-        varPal['indFname']=varPal['fname'].str.replace(r"^([^_]+)_(.+?)(\.pkl)?$",
+        varPal['indFname']=varPal['fname'].str.replace(r"^([^_]+)_(.+?)(\.pkl|\.zarr)?$",
                                                        indKey+r"_\2",
                                                        regex=True)
         #Build the rest of the path
@@ -257,8 +294,11 @@ def getWorkflow(config):
         #Only extract the dict for the part that we are actually
         #interested in
         useThese = varPal["varID"] == thisInd["variables"]
-        indDict[indKey] = {rw["indPath"]: [rw["path"]] \
+        useCube = config["processing"]["monthlyCube"] and indicators.usesMonthlyCube(thisInd)
+        indDict[indKey] = {rw["indPath"]: [rw["path"]] + ([rw["cubePath"]] if useCube else []) \
                                     for idx, rw in varPal[useThese].iterrows()}
+        if useCube:
+            cubeDict.update({rw["cubePath"]: [rw["path"]] for idx, rw in varPal[useThese].iterrows()})
 
     # Regridding-----------------------------------------------------------------------
     # We only regrid if it is requested in the configuration
@@ -305,15 +345,32 @@ def getWorkflow(config):
         .apply(lambda x: list(x["srcPath"]), include_groups=False)
         .to_dict()
     )
+    # Optionally, the members of each ensemble are collected into a single cube,
+    # which is then read in place of the member files by the downstream stages
+    useCubes = config["processing"]["ensembleCubes"]
+    if useCubes:
+        ensTbl["cubePath"] = [
+            os.path.join(outDirs["cache"], "ensembleCubes", f + ".zarr") for f in ensTbl["ensID"]
+        ]
+        ensCubeDict = (
+            ensTbl.groupby("cubePath")
+            .apply(lambda x: list(x["srcPath"]), include_groups=False)
+            .to_dict()
+        )
+        ensDict = {rw["ensPath"]: [rw["cubePath"]] for idx, rw in ensTbl.iterrows()}
+    else:
+        ensCubeDict = {}
 
     # Arealstatistics----------------------------------------------
     # Start by building list of input files to calculate arealstatistics for
     # Note that we split into ensemble and member statistics
     asEnsInps = pd.DataFrame(list(ensDict.keys()),columns=['srcPath'])
     asEnsInps['type']='ensstats'
-    asMemInps = pd.DataFrame([y for x in ensDict.values() for y in x],
-                             columns=['srcPath'])
+    asEnsInps['inPath']=asEnsInps['srcPath']
+    asMemInps = ensTbl[['srcPath']].copy()
     asMemInps['type']='members'
+    # Members are read from their slot in the ensemble cube, where used
+    asMemInps['inPath']=ensTbl['cubePath'] if useCubes else ensTbl['srcPath']
     asTbl=pd.concat([asEnsInps,asMemInps])
     # Now setup output structures
     asTbl["srcFname"] = [os.path.basename(p) for p in asTbl["srcPath"]]
@@ -323,9 +380,18 @@ def getWorkflow(config):
     # Make the dict
     asDict = (
         asTbl.groupby("asPath")
-        .apply(lambda x: list(x["srcPath"]), include_groups=False)
+        .apply(lambda x: list(x["inPath"]), include_groups=False)
         .to_dict()
     )
+    # Members read from the ensemble cube also depend on a flag that is only updated
+    # when the member itself changes. The cube is flagged as ancient in the Snakefile,
+    # so that only the members that have changed are recalculated when it is updated
+    memFlagDict = {}
+    if useCubes:
+        for idx, rw in asTbl[asTbl["type"] == "members"].iterrows():
+            flagPath = os.path.join(outDirs["cache"], "ensembleCubes", "members", rw["srcFname"])
+            memFlagDict[flagPath] = [rw["srcPath"]]
+            asDict[rw["asPath"]] = asDict[rw["asPath"]] + [flagPath]
 
     # Plots----------------------------------------------------
     #Get list of areal statistics csv files (in the ensstats version)
@@ -373,11 +439,14 @@ def getWorkflow(config):
 
     # Collate and round off----------------------------------------------
     rtn = {
+        "references": refDict,
         "primVars": pvDict,
         "secondaryVars": svDict,
         "calibratedVars":calDict,
+        "monthlyCubes": cubeDict,
         "indicators": indDict,
         "regridded": rgDict,
+        "ensembleCubes": ensCubeDict,
         "ensstats": ensDict,
         "arealstats": asDict,
         "plots": pltDict,
@@ -397,5 +466,16 @@ def getWorkflow(config):
             allList += v.keys()
     rtn["all"] = allList
 
+    # The slot in the ensemble cube holding each member, by areal statistics output
+    rtn["cubeMembers"] = {rw["asPath"]: rw["srcFname"] for idx, rw in asTbl.iterrows()
+                          if useCubes and (rw["type"] == "members")}
+    rtn["cubeMemberFlags"] = memFlagDict
+
+    # Resources-----------------------------------
+    # Memory and runtime of each job, estimated from the header information of the
+    # inputs
+    if config["processing"]["estimateResources"]:
+        rtn["resources"] = resources.estimateResources(config, rtn)
+
     # Fin-----------------------------------
     return rtn
@@ -0,0 +1,225 @@
+"""
+Benchmark harness for KAPy
+
+Runs each stage of the KAPy pipeline on a synthetic project (see syntheticData.py)
+and records the wall time, peak resident memory and the bytes read and written by
+each stage. Each stage is run in a fresh process, so that the measurements are
+independent of each other. Results can be stored as a baseline and subsequent runs
+compared against it.
+
+Usage (from the root of the repository):
+    > python workflow/benchmarks/runBenchmarks.py --outDir /tmp/KAPy-bench --saveBaseline
+    > python workflow/benchmarks/runBenchmarks.py --outDir /tmp/KAPy-bench
+
+Linux only, as the I/O counters are read from /proc.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import multiprocessing
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchDir, ".."))
+sys.path.insert(0, benchDir)
+
+# Stages, in order of execution
+stages = ["getWorkflow",
+          "buildReference",
+          "buildPrimVar",
+          "calibrate",
+          "buildMonthlyCube",
+          "calculateIndicators",
+          "regrid",
+          "buildEnsembleCube",
+          "generateEnsstats",
+          "generateArealstats"]
+
+
+def readIOCounters():
+    # Bytes read and written by this process, as seen by the kernel. rchar and wchar
+    # count all bytes passing through read and write calls, including those served
+    # from the page cache
+    with open("/proc/self/io", "r") as f:
+        counters = dict(line.strip().split(": ") for line in f)
+    return int(counters["rchar"]), int(counters["wchar"])
+
+
+def stageJobs(KAPy, config, wf, stage):
+    # List of calls required to run a stage, mirroring the rules in the Snakefile
+    jobs = []
+    if stage == "getWorkflow":
+        jobs += [(KAPy.getWorkflow, [config], {}, None)]
+    elif stage == "buildReference":
+        for outFile, inFiles in wf["references"].items():
+            jobs += [(KAPy.buildReference, [config, inFiles, [outFile]], {}, outFile)]
+    elif stage == "buildPrimVar":
+        for inpID, theseFiles in wf["primVars"].items():
+            for outFile, inFiles in theseFiles.items():
+                jobs += [(KAPy.buildPrimVar, [config, inFiles, [outFile], inpID], {}, outFile)]
+    elif stage == "calibrate":
+        for outFile, theseInps in wf["calibratedVars"].items():
+            jobs += [(KAPy.calibrate,
+                      [config, theseInps["histSim"], theseInps["ref"], [outFile]],
+                      {"thisCal": os.path.basename(os.path.dirname(outFile))}, outFile)]
+    elif stage == "buildMonthlyCube":
+        for outFile, inFiles in wf["monthlyCubes"].items():
+            jobs += [(KAPy.buildMonthlyCube, [config, inFiles, [outFile]], {}, outFile)]
+    elif stage == "calculateIndicators" and config["processing"]["fuseIndicators"]:
+        # One job per input file, covering all of the indicators that use it
+        fusedJobs = {}
+        for indID, theseFiles in wf["indicators"].items():
+            for outFile, inFiles in theseFiles.items():
+                thisJob = fusedJobs.setdefault(inFiles[0], {"inFiles": [], "outFile": [], "indIDs": []})
+                thisJob["inFiles"] += [f for f in inFiles if f not in thisJob["inFiles"]]
+                thisJob["outFile"] += [outFile]
+                thisJob["indIDs"] += [indID]
+        for thisJob in fusedJobs.values():
+            jobs += [(KAPy.calculateFusedIndicators,
+                      [config, thisJob["inFiles"], thisJob["outFile"], thisJob["indIDs"]], {}, thisJob["outFile"])]
+    elif stage == "calculateIndicators":
+        for indID, theseFiles in wf["indicators"].items():
+            for outFile, inFiles in theseFiles.items():
+                jobs += [(KAPy.calculateIndicators, [config, inFiles, [outFile], indID], {}, outFile)]
+    elif stage == "regrid":
+        for outFile, inFiles in wf["regridded"].items():
+            jobs += [(KAPy.regrid, [config, inFiles, [outFile]], {}, outFile)]
+    elif stage == "buildEnsembleCube":
+        for outFile, inFiles in wf["ensembleCubes"].items():
+            jobs += [(KAPy.buildEnsembleCube, [config, inFiles, [outFile]], {}, outFile)]
+    elif stage == "generateEnsstats":
+        for outFile, inFiles in wf["ensstats"].items():
+            jobs += [(KAPy.generateEnsstats, [config, inFiles, [outFile]], {}, outFile)]
+    elif stage == "generateArealstats":
+        for outFile, inFiles in wf["arealstats"].items():
+            jobs += [(KAPy.generateArealstats, [config, inFiles, [outFile]],
+                      {"member": wf["cubeMembers"].get(outFile)}, outFile)]
+    return jobs
+
+
+def runStage(cfgFile, stage, queue):
+    # Run all of the jobs in a single stage, in a fresh process. The measurements
+    # only cover the jobs themselves, and not the setup of the workflow
+    import KAPy
+    config = KAPy.getConfig(cfgFile)
+    wf = KAPy.getWorkflow(config)
+    jobs = stageJobs(KAPy, config, wf, stage)
+    for job in jobs:
+        theseOutFiles = job[3] if isinstance(job[3], list) else [job[3]]
+        for outFile in theseOutFiles:
+            if outFile is not None:
+                os.makedirs(os.path.dirname(outFile), exist_ok=True)
+    readStart, writeStart = readIOCounters()
+    timeStart = time.perf_counter()
+    for thisFn, args, kwargs, outFile in jobs:
+        thisFn(*args, **kwargs)
+    wallTime = time.perf_counter() - timeStart
+    readEnd, writeEnd = readIOCounters()
+    queue.put({"jobs": len(jobs),
+               "wallTime_s": wallTime,
+               "peakRSS_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               "read_MB": (readEnd - readStart) / 1024**2,
+               "written_MB": (writeEnd - writeStart) / 1024**2})
+
+
+def runBenchmarks(cfgFile, theseStages):
+    """
+    Run benchmarks
+
+    Runs each of the requested stages in turn on the project defined by `cfgFile`,
+    each in a freshly spawned process. Returns a dict of measurements by stage.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for stage in theseStages:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=runStage, args=(cfgFile, stage, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            sys.exit(f"Benchmark of stage '{stage}' failed with exit code {proc.exitcode}.")
+        results[stage] = queue.get()
+        print(f"{stage:<22} " + "  ".join([f"{k}={v:.2f}" for k, v in results[stage].items()]))
+    return results
+
+
+def compareBaseline(results, baseline, tolerance):
+    """
+    Compare with baseline
+
+    Prints the ratio of each measurement to the baseline value, flagging those that
+    exceed the baseline by more than `tolerance` (a fraction). Returns True if any
+    regressions are found.
+    """
+    regressions = False
+    print("\nComparison with baseline (ratio of current to baseline):")
+    for stage, theseResults in results.items():
+        if stage not in baseline:
+            print(f"{stage:<22} no baseline available")
+            continue
+        ratios = []
+        for metric in ["wallTime_s", "peakRSS_MB", "read_MB", "written_MB"]:
+            ref = baseline[stage][metric]
+            ratio = theseResults[metric] / ref if ref > 0 else 1.0
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = " REGRESSION"
+                regressions = True
+            ratios += [f"{metric}={ratio:.2f}{flag}"]
+        print(f"{stage:<22} " + "  ".join(ratios))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the KAPy pipeline on synthetic data")
+    parser.add_argument("--outDir", required=True, help="Working directory for the synthetic project")
+    parser.add_argument("--baseline", default=os.path.join(benchDir, "baseline.json"),
+                        help="Path to the baseline results file")
+    parser.add_argument("--saveBaseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fractional increase over the baseline that is flagged as a regression")
+    parser.add_argument("--stages", nargs="+", default=stages, choices=stages, help="Stages to run")
+    parser.add_argument("--nLon", type=int, default=40, help="Number of grid points in longitude")
+    parser.add_argument("--nLat", type=int, default=40, help="Number of grid points in latitude")
+    parser.add_argument("--nYears", type=int, default=40, help="Number of years of data")
+    parser.add_argument("--yearsPerFile", type=int, default=5, help="Number of years in each file")
+    parser.add_argument("--nMembers", type=int, default=3, help="Number of ensemble members")
+    parser.add_argument("--calendar", default="noleap", help="Calendar of the model data")
+    parser.add_argument("--processing", default="{}",
+                        help="Processing options to use, as a JSON string e.g. '{\"fuseIndicators\": true}'")
+    args = parser.parse_args()
+
+    # Generate a fresh project. Steps that need CDO are skipped if it isn't available
+    import syntheticData
+    useCDO = shutil.which("cdo") is not None
+    if os.path.exists(args.outDir):
+        shutil.rmtree(args.outDir)
+    cfgFile = syntheticData.makeSyntheticProject(args.outDir,
+                                                 useCDO=useCDO,
+                                                 nLon=args.nLon,
+                                                 nLat=args.nLat,
+                                                 nYears=args.nYears,
+                                                 yearsPerFile=args.yearsPerFile,
+                                                 nMembers=args.nMembers,
+                                                 calendar=args.calendar,
+                                                 processing=json.loads(args.processing))
+    theseStages = [s for s in args.stages
+                   if useCDO or s not in ["calibrate", "regrid"]]
+    if len(theseStages) < len(args.stages):
+        print("CDO not found - skipping calibration and regridding.")
+
+    # Run, and compare with or store the baseline
+    results = runBenchmarks(cfgFile, theseStages)
+    if args.saveBaseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if compareBaseline(results, baseline, args.tolerance):
+            sys.exit(1)
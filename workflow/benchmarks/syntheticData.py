@@ -0,0 +1,232 @@
+"""
+Synthetic CORDEX-like input data for benchmarking KAPy
+
+Generates daily NetCDF files that mimic the structure and file naming of CORDEX
+output, together with a reference (reanalysis-like) data set and a complete KAPy
+project configuration that uses them. Everything is generated locally, so that the
+pipeline can be exercised without downloading any data.
+
+Usage (from the root of the repository):
+    > python workflow/benchmarks/syntheticData.py --outDir /tmp/KAPy-synthetic
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+# Time encoding used for all synthetic files
+timeUnits = "days since 1949-12-01 00:00:00"
+
+
+def makeField(times, lat, lon, rng, offset=0.0):
+    # Build a temperature-like field: a seasonal cycle that varies with latitude,
+    # a weak trend and day-to-day noise. Generated as float32, as model output usually is
+    doy = np.array([t.dayofyr for t in times])
+    yrs = np.array([t.year for t in times])
+    seasonal = 10 * np.cos(2 * np.pi * (doy - 200) / 365)[:, None, None]
+    latGrad = -0.5 * lat[None, :, None]
+    trend = 0.03 * (yrs - yrs[0])[:, None, None]
+    noise = rng.normal(0, 2, (len(times), len(lat), len(lon)))
+    dat = 290 + offset + seasonal + latGrad + trend + noise
+    return dat.astype(np.float32)
+
+
+def makeGrid(nLon, nLat, resolution, lonFirst=-4.0, latFirst=4.0):
+    # Regular lon-lat grid
+    lon = lonFirst + resolution * np.arange(nLon)
+    lat = latFirst + resolution * np.arange(nLat)
+    return lon, lat
+
+
+def writeFile(dat, times, lon, lat, varName, calendar, path):
+    # Write a single CF-compliant NetCDF file
+    ds = xr.Dataset(
+        {varName: (("time", "lat", "lon"), dat, {"units": "K",
+                                                  "standard_name": "air_temperature"})},
+        coords={"time": times,
+                "lat": ("lat", lat, {"units": "degrees_north",
+                                     "standard_name": "latitude"}),
+                "lon": ("lon", lon, {"units": "degrees_east",
+                                     "standard_name": "longitude"})})
+    ds.to_netcdf(path,
+                 encoding={"time": {"units": timeUnits, "calendar": calendar}},
+                 unlimited_dims=["time"])
+
+
+def makeSyntheticInputs(outDir,
+                        nLon=40,
+                        nLat=40,
+                        resolution=0.44,
+                        startYear=1981,
+                        nYears=40,
+                        yearsPerFile=5,
+                        nMembers=3,
+                        calendar="noleap",
+                        splitYear=2006,
+                        seed=42):
+    """
+    Make synthetic input files
+
+    Writes `nMembers` CORDEX-like ensemble members of daily near-surface temperature,
+    split into files of `yearsPerFile` years. Files starting before `splitYear` are
+    labelled as the historical experiment and the remainder as rcp85. A single-file
+    reference data set on a finer grid is also written. Returns a dict describing what
+    was generated.
+    """
+    rng = np.random.default_rng(seed)
+    inpDir = os.path.join(outDir, "inputs")
+    os.makedirs(inpDir, exist_ok=True)
+    lon, lat = makeGrid(nLon, nLat, resolution)
+    endYear = startYear + nYears - 1
+
+    # Model ensemble
+    experiments = set()
+    for m in range(nMembers):
+        for y0 in range(startYear, endYear + 1, yearsPerFile):
+            y1 = min(y0 + yearsPerFile - 1, endYear)
+            times = xr.date_range(f"{y0}-01-01", f"{y1}-12-31", freq="D",
+                                  calendar=calendar, use_cftime=True)
+            expt = "historical" if y0 < splitYear else "rcp85"
+            experiments.add(expt)
+            fname = f"tas_SYN-44_GCM{m+1}_{expt}_r1i1p1_RCM{m+1}_v1_day_{y0}0101-{y1}1231.nc"
+            writeFile(makeField(times, lat, lon, rng, offset=m * 0.5),
+                      times, lon, lat, "tas", calendar, os.path.join(inpDir, fname))
+
+    # Reference data set, on a grid at twice the resolution, with a standard calendar
+    refLon, refLat = makeGrid(2 * nLon, 2 * nLat, resolution / 2)
+    refEnd = min(endYear, startYear + 29)
+    times = xr.date_range(f"{startYear}-01-01", f"{refEnd}-12-31", freq="D",
+                          calendar="standard", use_cftime=True)
+    writeFile(makeField(times, refLat, refLon, rng, offset=-1.0),
+              times, refLon, refLat, "t2m", "standard",
+              os.path.join(inpDir, "t2m_REF_daily.nc"))
+
+    return {"inputDir": inpDir,
+            "lon": lon,
+            "lat": lat,
+            "startYear": startYear,
+            "endYear": endYear,
+            "refEndYear": refEnd,
+            "experiments": sorted(experiments)}
+
+
+def makeSyntheticProject(outDir, useCDO=True, processing={}, **kwargs):
+    """
+    Make a synthetic KAPy project
+
+    Generates the synthetic inputs with makeSyntheticInputs() and writes the full
+    set of KAPy configuration files to run on them into `outDir`. CDO-dependent
+    steps (regridding and calibration) are only configured when `useCDO` is set.
+    Additional options for the `processing` section of the configuration can be
+    supplied via `processing`. Returns the path to the configuration file.
+    """
+    info = makeSyntheticInputs(outDir, **kwargs)
+    cfgDir = os.path.join(outDir, "config")
+    os.makedirs(cfgDir, exist_ok=True)
+
+    def writeTable(rows, fname):
+        thisPath = os.path.join(cfgDir, fname)
+        pd.DataFrame(rows).to_csv(thisPath, sep="\t", index=False)
+        return thisPath
+
+    # Configuration tables
+    commonExpt = "historical" if len(info["experiments"]) > 1 else ""
+    inputsTbl = writeTable([
+        {"id": "SYN-tas", "varID": "tas", "srcID": "SYN", "gridID": "SYN-44",
+         "path": os.path.join(info["inputDir"], "tas_SYN-44_*"),
+         "internalVarName": "tas", "fieldSeparator": "_", "experimentField": "4",
+         "commonExperimentID": commonExpt, "ensMemberFields": "3,5,6,7,8,2",
+         "importScriptPath": "", "importScriptFunction": ""},
+        {"id": "REF-tas", "varID": "tas", "srcID": "REF", "gridID": "REF-grid",
+         "path": os.path.join(info["inputDir"], "t2m_REF_daily.nc"),
+         "internalVarName": "t2m", "fieldSeparator": "", "experimentField": "",
+         "commonExperimentID": "", "ensMemberFields": "",
+         "importScriptPath": "", "importScriptFunction": ""}], "inputs.tsv")
+    indicatorsTbl = writeTable([
+        {"id": "101", "name": "Mean temperature", "units": "K", "variables": "tas",
+         "season": "annual", "statistic": "mean", "time_binning": "periods"},
+        {"id": "102", "name": "Mean temperature", "units": "K", "variables": "tas",
+         "season": "annual", "statistic": "mean", "time_binning": "years"},
+        {"id": "103", "name": "Mean summer temperature", "units": "K", "variables": "tas",
+         "season": "summer", "statistic": "mean", "time_binning": "months"}],
+        "indicators.tsv")
+    periodStarts = range(info["startYear"], info["endYear"] + 1, 10)
+    periodsTbl = writeTable([{"id": str(i + 1), "name": f"Period {i+1}",
+                              "start": str(y), "end": str(min(y + 9, info["endYear"]))}
+                             for i, y in enumerate(periodStarts)], "periods.tsv")
+    seasonsTbl = writeTable([
+        {"id": "annual", "name": "Annual", "months": "1,2,3,4,5,6,7,8,9,10,11,12"},
+        {"id": "summer", "name": "Summer (JJA)", "months": "6,7,8"}], "seasons.tsv")
+    cfgTables = {"inputs": inputsTbl,
+                 "indicators": indicatorsTbl,
+                 "periods": periodsTbl,
+                 "seasons": seasonsTbl}
+    if useCDO:
+        cfgTables["calibration"] = writeTable([
+            {"id": "tas-cal", "outVariable": "tas-cal", "calibrationVariable": "tas",
+             "calibSource": "SYN", "refSource": "REF",
+             "calPeriodStart": str(info["startYear"]),
+             "calPeriodEnd": str(info["refEndYear"]),
+             "method": "xclim-scaling", "grouping": "month",
+             "additionalArgs": "{'kind':'+'}",
+             "customScriptPath": "", "customScriptFunction": ""}], "calibration.tsv")
+
+    # Output grid for regridding, at half the resolution of the inputs
+    lon, lat = info["lon"], info["lat"]
+    griddes = os.path.join(cfgDir, "griddes.txt")
+    with open(griddes, "w") as f:
+        f.write("gridtype = lonlat\n"
+                + f"xsize = {len(lon)//2}\nysize = {len(lat)//2}\n"
+                + f"xfirst = {lon[0]}\nxinc = {2*(lon[1]-lon[0])}\n"
+                + f"yfirst = {lat[0]}\nyinc = {2*(lat[1]-lat[0])}\n")
+
+    # Configuration file
+    outputs = os.path.join(outDir, "outputs")
+    cfg = {
+        "configurationTables": cfgTables,
+        "dirs": {"variables": os.path.join(outputs, "1.variables"),
+                 "calibration": os.path.join(outputs, "2.calibration"),
+                 "indicators": os.path.join(outputs, "3.indicators"),
+                 "regridded": os.path.join(outputs, "4.common_grid"),
+                 "ensstats": os.path.join(outputs, "5.ensstats"),
+                 "arealstats": os.path.join(outputs, "6.areal_statistics"),
+                 "plots": os.path.join(outputs, "7.plots"),
+                 "cache": os.path.join(outputs, "0.cache")},
+        "arealstats": {"useAreaWeighting": useCDO, "shapefile": "", "idColumn": ""},
+        "cutouts": {"method": "none"},
+        "ensembles": {"upperPercentile": 90, "centralPercentile": 50, "lowerPercentile": 10},
+        "outputGrid": ({"regriddingEngine": "cdo", "gridName": "SYN-88", "cdoGriddes": griddes}
+                       if useCDO else {"regriddingEngine": "none"}),
+        "processing": {"primaryVariableFormat": "netcdf", **processing},
+    }
+    cfgFile = os.path.join(cfgDir, "config.yaml")
+    with open(cfgFile, "w") as f:
+        yaml.safe_dump(cfg, f, sort_keys=False)
+    return cfgFile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic CORDEX-like inputs and a KAPy project")
+    parser.add_argument("--outDir", required=True, help="Directory in which to generate the project")
+    parser.add_argument("--nLon", type=int, default=40, help="Number of grid points in longitude")
+    parser.add_argument("--nLat", type=int, default=40, help="Number of grid points in latitude")
+    parser.add_argument("--startYear", type=int, default=1981, help="First year of data")
+    parser.add_argument("--nYears", type=int, default=40, help="Number of years of data")
+    parser.add_argument("--yearsPerFile", type=int, default=5, help="Number of years in each file")
+    parser.add_argument("--nMembers", type=int, default=3, help="Number of ensemble members")
+    parser.add_argument("--calendar", default="noleap", help="Calendar of the model data")
+    parser.add_argument("--noCDO", action="store_true", help="Don't configure steps requiring CDO")
+    args = parser.parse_args()
+    cfgFile = makeSyntheticProject(args.outDir,
+                                   useCDO=not args.noCDO,
+                                   nLon=args.nLon,
+                                   nLat=args.nLat,
+                                   startYear=args.startYear,
+                                   nYears=args.nYears,
+                                   yearsPerFile=args.yearsPerFile,
+                                   nMembers=args.nMembers,
+                                   calendar=args.calendar)
+    print(f"Synthetic project configuration written to {cfgFile}")